@@ -1,26 +1,19 @@
 __author__ = 'mpevans'
 import math
+import os
+import time
 import itertools
+import heapq
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
 from fractions import Fraction
+import numpy as np
+from marcpy.utilities import memoize
 
 
 # ---------------------------------------------- Utility Functions -------------------------------------------------
-# decorator that saves function output
-def save_answers(func):
-    func.answers = {}
-
-    def func_wrapper(*args):
-        t_args = tuple(args)
-        if t_args in func.answers:
-            return func.answers[t_args]
-        else:
-            ans = func(*args)
-            func.answers[t_args] = ans
-            return ans
-
-    return func_wrapper
-
-
 def gcd(a, b):
     """Return greatest common divisor using Euclid's Algorithm."""
     while b:
@@ -33,11 +26,78 @@ def lcm(a, b):
     return a * b // gcd(a, b)
 
 
+# a table of the smallest prime factor of every composite number below its length (with 0 marking the primes), which
+# grows itself as needed. Below _max_sieve_size the smallest prime factor of a composite is at most 4096, so 16 bits
+# per number is enough.
+_smallest_prime_factors = np.ones(2, dtype=np.uint16)
+# the primes in the table, only worked out (from the table) when get_nth_prime needs them
+_sieved_primes = None
+_min_sieve_size = 2 ** 16
+# past this, numbers are checked and factored by trial division, rather than growing the table without bound
+_max_sieve_size = 2 ** 24
+
+
+def _extend_sieve(minimum_size):
+    global _smallest_prime_factors, _sieved_primes
+    if minimum_size <= len(_smallest_prime_factors):
+        return
+    # at least double it each time, so that growing it bit by bit doesn't cost much
+    size = min(max(minimum_size, 2 * len(_smallest_prime_factors), _min_sieve_size), _max_sieve_size)
+    smallest_prime_factors = np.zeros(size, dtype=np.uint16)
+    for k in range(2, int(size ** 0.5) + 1):
+        if smallest_prime_factors[k] == 0:
+            multiples = smallest_prime_factors[k*k::k]
+            multiples[multiples == 0] = k
+    smallest_prime_factors[:2] = 1
+    _smallest_prime_factors = smallest_prime_factors
+    _sieved_primes = None
+
+
+def _is_in_sieve(n):
+    # whether n can be looked up in the table, extending the table if n is not far past its end (within the next
+    # doubling). Numbers far beyond it are cheaper to handle one-off by trial division than by growing the table.
+    if n < len(_smallest_prime_factors):
+        return True
+    if n < min(max(2 * len(_smallest_prime_factors), _min_sieve_size), _max_sieve_size):
+        _extend_sieve(n + 1)
+        return True
+    return False
+
+
+def _get_sieved_primes():
+    global _sieved_primes
+    if _sieved_primes is None:
+        _sieved_primes = np.flatnonzero(_smallest_prime_factors == 0)
+    return _sieved_primes
+
+
+def _as_integer(n):
+    # integral floats (like 7.0) and numpy integers are treated as the ints they are equal to
+    if isinstance(n, np.integer) or isinstance(n, float) and n.is_integer():
+        return int(n)
+    return n
+
+
 def is_prime(a):
-    return not (a < 2 or any(a % x == 0 for x in range(2, int(a ** 0.5) + 1)))
+    a = _as_integer(a)
+    if a < 2:
+        return False
+    if isinstance(a, (int, long)) and _is_in_sieve(a):
+        return bool(_smallest_prime_factors[a] == 0)
+    return not any(a % x == 0 for x in range(2, int(a ** 0.5) + 1))
 
 
 def prime_factor(n):
+    n = _as_integer(n)
+    if isinstance(n, (int, long)) and n >= 1 and _is_in_sieve(n):
+        primes = []
+        while n > 1:
+            # (zero in the table means n itself is prime)
+            factor = int(_smallest_prime_factors[n]) or n
+            primes.append(factor)
+            n //= factor
+        return primes
+
     i = 2
     primes = []
     while i * i <= n:
@@ -58,53 +118,157 @@ def rotate(l, n):
 
 def get_nth_prime(n):
     # counting 2 as the 0th prime
-    if n == 0:
-        return 2
-
-    if hasattr(get_nth_prime, "primes"):
-        assert isinstance(get_nth_prime.primes, list)
-        if n < len(get_nth_prime.primes):
-            return get_nth_prime.primes[n]
-        else:
-            k = get_nth_prime.primes[len(get_nth_prime.primes) - 1] + 1
-    else:
-        get_nth_prime.primes = [2]
-        k = 3
-
-    while len(get_nth_prime.primes) <= n:
-        # get the next prime
-        found_a_prime = True
-        for prime in get_nth_prime.primes:
-            if k % prime == 0:
-                found_a_prime = False
-                break
-        if found_a_prime:
-            get_nth_prime.primes.append(k)
-        else:
-            k += 1
-
-    return k
+    while n >= len(_get_sieved_primes()):
+        if len(_smallest_prime_factors) >= _max_sieve_size:
+            raise ValueError("Can't find primes beyond " + str(_max_sieve_size))
+        _extend_sieve(2 * len(_smallest_prime_factors))
+    return int(_get_sieved_primes()[n])
 
 
 def gaussian_discount(x, center, standard_deviation):
     return math.exp(-(x-center)**2/(2*standard_deviation**2))
 
 
+# ---------------------------------------------- Persistent Cache -------------------------------------------------
+# Prime pools, ratio lattices and indispensability arrays can also be kept on disk, so that a fresh interpreter
+# doesn't have to work them out all over again. This is off unless a cache directory is given, either with
+# set_cache_directory or with the MARCPY_CACHE_DIR environment variable. Each entry is a directory of .npy files,
+# which get memory-mapped when loaded.
+
+# bump this whenever the way any of the cached things are calculated changes, so old entries are ignored
+_disk_cache_version = 1
+_disk_cache_directory = os.environ.get("MARCPY_CACHE_DIR")
+
+
+def set_cache_directory(path):
+    # None turns the persistent cache off
+    global _disk_cache_directory
+    _disk_cache_directory = path
+
+
+def get_cache_directory():
+    return _disk_cache_directory
+
+
+def clear_cache_directory():
+    # removes all of the entries (of any version) from the cache directory
+    if _disk_cache_directory is None or not os.path.isdir(_disk_cache_directory):
+        return
+    for entry in os.listdir(_disk_cache_directory):
+        if entry.startswith("barlicity_"):
+            shutil.rmtree(os.path.join(_disk_cache_directory, entry), ignore_errors=True)
+
+
+def _get_disk_cache_path(kind, key):
+    key_hash = hashlib.sha1(repr(key)).hexdigest()
+    return os.path.join(_disk_cache_directory,
+                        "barlicity_" + kind + "_v" + str(_disk_cache_version) + "_" + key_hash)
+
+
+def _load_from_disk_cache(kind, key):
+    # returns a dictionary of (memory-mapped) arrays, or None if the cache is off or doesn't have this entry
+    if _disk_cache_directory is None:
+        return None
+    path = _get_disk_cache_path(kind, key)
+    if not os.path.isdir(path):
+        return None
+    try:
+        return dict((file_name[:-4], np.load(os.path.join(path, file_name), mmap_mode="r"))
+                    for file_name in os.listdir(path) if file_name.endswith(".npy"))
+    except (IOError, ValueError):
+        # a damaged entry is just treated as missing
+        return None
+
+
+def _save_to_disk_cache(kind, key, arrays):
+    # arrays is a dictionary of numpy arrays. Arrays of python objects can't be memory-mapped, so we don't bother
+    if _disk_cache_directory is None or any(array.dtype == object for array in arrays.values()):
+        return
+    if not os.path.isdir(_disk_cache_directory):
+        os.makedirs(_disk_cache_directory)
+    # the entry is written to a temporary directory and then renamed, so other processes never see half of it
+    # (the prefix means that clear_cache_directory also cleans up after writers that died part way through)
+    temporary_path = tempfile.mkdtemp(prefix="barlicity_tmp_", dir=_disk_cache_directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary_path, name + ".npy"), array)
+    try:
+        os.rename(temporary_path, _get_disk_cache_path(kind, key))
+    except OSError:
+        # someone else got there first
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+
 # ---------------------------------------- Indigestibility and Harmonicity ------------------------------------------
 
 
 def indigestibility(n):
-    assert isinstance(n, int) and n > 0
+    # n can also be an array (or list) of positive integers, in which case we return an array
+    if hasattr(n, "__len__"):
+        return _indigestibility_of_array(np.asarray(n))
+    assert isinstance(n, (int, long, np.integer)) and n > 0
     if is_prime(n):
         return 2 * float((n-1)**2) / n
     else:
         total = 0
+        # (the factors are all prime, so this is the same as adding up their indigestibilities)
         for factor in prime_factor(n):
-            total += indigestibility(factor)
+            total += 2 * float((factor-1)**2) / factor
         return total
 
 
+def _indigestibility_of_array(numbers):
+    assert np.issubdtype(numbers.dtype, np.integer) and np.all(numbers > 0)
+    if numbers.size == 0:
+        return np.zeros(numbers.shape)
+    largest = int(numbers.max())
+    if largest >= 2 ** 31:
+        # (too big to square in 64 bits)
+        return np.array([indigestibility(int(x)) for x in numbers.flat]).reshape(numbers.shape)
+    # if the numbers go far past the end of the table, it only needs to cover their square roots
+    if not _is_in_sieve(largest):
+        _extend_sieve(int(largest ** 0.5) + 1)
+    sieve_size = len(_smallest_prime_factors)
+    totals = np.zeros(numbers.size)
+    remaining = numbers.astype(np.int64).ravel()
+    # strip off the prime factors from smallest to largest, adding them up in the same order as indigestibility()
+    # does, so the results match it exactly. First, numbers past the end of the table have their factors up to the
+    # square root of the largest divided out one prime at a time, until what's left of them is within the table...
+    beyond_sieve = np.flatnonzero(remaining >= sieve_size)
+    if beyond_sieve.size > 0:
+        primes = _get_sieved_primes()
+        for p in primes[:np.searchsorted(primes, int(largest ** 0.5), side="right")]:
+            while True:
+                divisible = beyond_sieve[remaining[beyond_sieve] % p == 0]
+                if divisible.size == 0:
+                    break
+                totals[divisible] += 2 * float((p-1)**2) / p
+                remaining[divisible] //= p
+            beyond_sieve = beyond_sieve[remaining[beyond_sieve] >= sieve_size]
+            if beyond_sieve.size == 0:
+                break
+        # ...or else it has no factors up to its square root, so it's prime
+        last_factors = remaining[beyond_sieve]
+        totals[beyond_sieve] += 2 * ((last_factors - 1) ** 2).astype(float) / last_factors
+        remaining[beyond_sieve] = 1
+    # ...then the rest are looked up in the table
+    while True:
+        unfinished = remaining > 1
+        if not np.any(unfinished):
+            return totals.reshape(numbers.shape)
+        smallest_factors = _smallest_prime_factors[remaining].astype(np.int64)
+        factors = np.where(unfinished, np.where(smallest_factors == 0, remaining, smallest_factors), 1)
+        totals += np.where(unfinished, 2 * ((factors - 1) ** 2).astype(float) / factors, 0)
+        remaining //= factors
+
+
 def harmonicity(p, q):
+    # p and q can also be arrays (or lists) of positive integers, in which case we return an array
+    if hasattr(p, "__len__") or hasattr(q, "__len__"):
+        indig_p = indigestibility(np.asarray(p))
+        indig_q = indigestibility(np.asarray(q))
+        with np.errstate(divide="ignore"):
+            return np.where(indig_p + indig_q == 0, float("inf"),
+                            np.copysign(1/(indig_p + indig_q), indig_q - indig_p))
     indig_p = indigestibility(p)
     indig_q = indigestibility(q)
     if indig_p + indig_q == 0:
@@ -129,7 +293,7 @@ def _get_max_prime_power(the_prime, min_harmonicity, max_octave_range=8):
 # I think it could be made still quicker by splitting it up still more
 # basically we are pitting the efficiency of itertools.product with the efficiency of checking fewer possibilities
 # but using more python code
-@save_answers
+@memoize(max_size=32)
 def _get_candidate_prime_pool(min_harmonicity, high_low_cutoff=0.25):
     max_inharmonicity = 1.0 / min_harmonicity
     max_primes = []
@@ -187,63 +351,529 @@ def _get_candidate_prime_pool_old(min_harmonicity, high_low_cutoff=0.25):
     return acceptable_prime_combos
 
 
+# the prime pool as a numpy array of exponents (one row per prime combination), along with the primes themselves
+@memoize(max_size=32)
+def _get_prime_exponent_matrix(min_harmonicity):
+    cached_arrays = _load_from_disk_cache("prime_pool", (min_harmonicity,))
+    if cached_arrays is not None:
+        exponents = cached_arrays["exponents"]
+    else:
+        exponents = np.array(_get_candidate_prime_pool(min_harmonicity), dtype=np.int64)
+        _save_to_disk_cache("prime_pool", (min_harmonicity,), {"exponents": exponents})
+    primes = [get_nth_prime(i) for i in range(exponents.shape[1])]
+    return exponents, primes
+
+
+def _exponents_to_ratio(exponents, on_top, primes):
+    # done with python ints so that large ratios don't overflow
+    top = 1
+    bottom = 1
+    for prime, power, is_on_top in zip(primes, exponents, on_top):
+        if is_on_top:
+            top *= prime ** int(power)
+        else:
+            bottom *= prime ** int(power)
+    return top, bottom
+
+
+class RatioLattice:
+    """
+    Every ratio that satisfies a minimum harmonicity, sorted by size in cents, so that the ones in any cent range
+    can be found by binary search. Build these with get_ratio_lattice, which only builds each one once.
+    """
+
+    # the arrays that make up a lattice, which are all that's needed to rebuild it
+    array_names = ("cents", "orders", "tops", "bottoms", "harmonicities")
+
+    def __init__(self, min_harmonicity, arrays=None):
+        self.min_harmonicity = min_harmonicity
+        if arrays is not None:
+            # rebuilding from a dictionary of arrays, as given by get_arrays
+            for name in RatioLattice.array_names:
+                setattr(self, name, arrays[name])
+            return
+
+        exponents, primes = _get_prime_exponent_matrix(min_harmonicity)
+        prime_cents = 1200 * np.log2(primes)
+        # the indigestibility of a product of primes, added up one prime factor at a time in the same order as
+        # indigestibility() does it, so that the harmonicities come out exactly the same
+        prime_indigestibilities = [indigestibility(prime) for prime in primes]
+
+        all_cents = []
+        all_tops = []
+        all_bottoms = []
+        all_orders = []
+        # if you put 2s on top, no need to put them on bottom, since they'd cancel
+        # so for each prime type, it could be on top or bottom
+        for i, tops_and_bottoms in enumerate(itertools.product(*[[True, False]]*len(primes))):
+            on_top = np.array(tops_and_bottoms)
+            # a prime with a power of zero is the same on top or bottom, so we only count it when it's on top
+            rows = np.flatnonzero(np.all(exponents[:, ~on_top] > 0, axis=1))
+            top_exponents = exponents[rows] * on_top
+            bottom_exponents = exponents[rows] * ~on_top
+            all_cents.append(exponents[rows].dot(np.where(on_top, prime_cents, -prime_cents)))
+            all_tops.append(top_exponents)
+            all_bottoms.append(bottom_exponents)
+            # the position of each ratio in the order that the original generate_ratio_candidates found them
+            all_orders.append(i * len(exponents) + rows)
+
+        cents = np.concatenate(all_cents)
+        sort_order = np.argsort(cents, kind="mergesort")
+        top_exponents = np.concatenate(all_tops)[sort_order]
+        bottom_exponents = np.concatenate(all_bottoms)[sort_order]
+        # sorted by size in cents
+        self.cents = cents[sort_order]
+        self.orders = np.concatenate(all_orders)[sort_order]
+
+        # numpy ints are fine unless the numbers get too big, in which case we fall back to python ints
+        if (top_exponents + bottom_exponents).dot(np.log2(primes)).max() < 62:
+            self.tops = np.prod(np.power(primes, top_exponents), axis=1)
+            self.bottoms = np.prod(np.power(primes, bottom_exponents), axis=1)
+        else:
+            self.tops = np.array([_exponents_to_ratio(row, [True] * len(primes), primes)[0]
+                                  for row in top_exponents], dtype=object)
+            self.bottoms = np.array([_exponents_to_ratio(row, [True] * len(primes), primes)[0]
+                                     for row in bottom_exponents], dtype=object)
+
+        top_indigestibilities = np.zeros(len(self.cents))
+        bottom_indigestibilities = np.zeros(len(self.cents))
+        for k, prime_indigestibility in enumerate(prime_indigestibilities):
+            for power in range(1, exponents[:, k].max() + 1):
+                top_indigestibilities += np.where(top_exponents[:, k] >= power, prime_indigestibility, 0)
+                bottom_indigestibilities += np.where(bottom_exponents[:, k] >= power, prime_indigestibility, 0)
+        total_indigestibilities = top_indigestibilities + bottom_indigestibilities
+        with np.errstate(divide="ignore"):
+            self.harmonicities = np.copysign(1 / total_indigestibilities,
+                                             bottom_indigestibilities - top_indigestibilities)
+
+    def __len__(self):
+        return len(self.cents)
+
+    def get_arrays(self):
+        return dict((name, getattr(self, name)) for name in RatioLattice.array_names)
+
+    def get_ratios_in_range(self, cent_range_low, cent_range_high):
+        """
+        Returns a list of (ratio, harmonicity) for all ratios strictly between cent_range_low and cent_range_high,
+        where each ratio is a (numerator, denominator) tuple. They come in the order that generate_ratio_candidates
+        originally found them in, rather than by size.
+        """
+        interval_lower_bound = 2**(cent_range_low/1200.0)
+        interval_upper_bound = 2**(cent_range_high/1200.0)
+        # we search in the log domain with a little slack, and then do the exact check on the few survivors, so that
+        # floating point error can't change which ratios get included at the edges of the range
+        slack = 1e-6 * max(abs(cent_range_low), abs(cent_range_high), 1)
+        start = np.searchsorted(self.cents, cent_range_low - slack, side="left")
+        end = np.searchsorted(self.cents, cent_range_high + slack, side="right")
+        ratios_in_range = []
+        for k in np.argsort(self.orders[start:end], kind="mergesort") + start:
+            top, bottom = int(self.tops[k]), int(self.bottoms[k])
+            if interval_lower_bound < float(top)/bottom < interval_upper_bound:
+                ratios_in_range.append(((top, bottom), float(self.harmonicities[k])))
+        return ratios_in_range
+
+
+# lattices can get big, so we only hold on to a handful of them
+@memoize(max_size=8)
+def get_ratio_lattice(min_harmonicity):
+    cached_arrays = _load_from_disk_cache("ratio_lattice", (min_harmonicity,))
+    if cached_arrays is not None:
+        return RatioLattice(min_harmonicity, cached_arrays)
+    ratio_lattice = RatioLattice(min_harmonicity)
+    _save_to_disk_cache("ratio_lattice", (min_harmonicity,), ratio_lattice.get_arrays())
+    return ratio_lattice
+
+
 # generates all possible ratios within a cent range that satisfy a minimum harmonicity
 def generate_ratio_candidates((cent_range_low, cent_range_high), min_harmonicity):
-    ratio_candidates = []
-
-    interval_lower_bound = 2**(cent_range_low/1200.0)
-    interval_upper_bound = 2**(cent_range_high/1200.0)
-    # generate a whole bunch of ratios in the neighborhood of this cent interval
     # the candidates are based on a given lower harmonicity threshold (0.04 is the most common that Clarence uses)
-    prime_combos = _get_candidate_prime_pool(min_harmonicity)
-    top_bottom_options = itertools.product(*[[True, False]]*len(prime_combos[0]))
-    # if you put 2s on top, no need to put them on bottom, since they'd cancel
-    # so for each prime type, it could be on top or bottom
-    # THIS IS THE SLOW PART
-    # could probably be made much more efficient with numpy
-    for tops_and_bottoms in top_bottom_options:
-        for prime_combo in prime_combos:
-            top = 1
-            bottom = 1
-            for i, power in enumerate(prime_combo):
-                if tops_and_bottoms[i]:
-                    top *= get_nth_prime(i) ** power
-                else:
-                    bottom *= get_nth_prime(i) ** power
-            if interval_lower_bound < float(top)/bottom < interval_upper_bound:
-                ratio_candidates.append((top, bottom))
-    return set(ratio_candidates)
+    ratio_lattice = get_ratio_lattice(min_harmonicity)
+    return set(ratio for ratio, _ in ratio_lattice.get_ratios_in_range(cent_range_low, cent_range_high))
 
 
 # nominal tolerance applies a gaussian envelope whereby ratios that are the nominal tolerance away are discounted 95%
 # this happens at 2.447 * the standard deviation, so standard dev = nominal_tolerance / 2.447
 # also we'll only generate possibilities within the nominal tolerance, since more than 95% overwhelming
 def get_ratio_candidates(desired_cent_ratio, nominal_tolerance, min_harmonicity, num_candidates=None):
-    ratio_candidates = generate_ratio_candidates((desired_cent_ratio - nominal_tolerance,
-                                                  desired_cent_ratio + nominal_tolerance), min_harmonicity)
+    ratios_in_range = get_ratio_lattice(min_harmonicity).get_ratios_in_range(desired_cent_ratio - nominal_tolerance,
+                                                                            desired_cent_ratio + nominal_tolerance)
+    ratio_harmonicities = dict(ratios_in_range)
     candidates_and_values = []
-    for ratio in ratio_candidates:
+    # going through them as a set keeps equally good candidates in the same order as always
+    for ratio in set(ratio for ratio, _ in ratios_in_range):
         cent_ratio = math.log(float(ratio[0])/ratio[1])/math.log(2) * 1200
         discount = gaussian_discount(cent_ratio, desired_cent_ratio, nominal_tolerance / 2.447)
-        candidates_and_values.append((ratio, math.fabs(harmonicity(*ratio)) * discount))
+        candidates_and_values.append((ratio, math.fabs(ratio_harmonicities[ratio]) * discount))
     candidates_and_values.sort(key=lambda x : x[1], reverse=True)
     return [cv[0] for cv in candidates_and_values] if num_candidates is None else \
         [cv[0] for cv in candidates_and_values[:num_candidates]]
 
 
+def get_interval_inharmonicity(ratio_1, ratio_2):
+    # ratio_1 and ratio_2 are something like (27, 16) and (15, 8)
+    # what we want is to look at the absolute harmonicity of (15*16) / (27*8)
+    # the Fraction class reduces it for us, probably pretty efficiently
+    reduced_fraction = Fraction(ratio_1[1]*ratio_2[0], ratio_1[0]*ratio_2[1])
+    return indigestibility(reduced_fraction.numerator) + indigestibility(reduced_fraction.denominator)
+
+
 def get_tuning_inharmonicity(the_tuning):
     total_inharmonicity = 0
     for interval in itertools.combinations(the_tuning, 2):
-        # interval is something like ((27, 16), (15, 8))
-        # what we want is to look at the absolute harmonicity of (15*16) / (27*8)
-        # the Fraction class reduces it for us, probably pretty efficiently
-        reduced_fraction = Fraction(interval[0][1]*interval[1][0], interval[0][0]*interval[1][1])
-        total_inharmonicity += indigestibility(reduced_fraction.numerator) + \
-                              indigestibility(reduced_fraction.denominator)
+        total_inharmonicity += get_interval_inharmonicity(*interval)
     return total_inharmonicity
 
 
-def rationalize_scale(cents_values, nominal_tolerance, min_harmonicity, num_candidates, num_to_return=None, write_pretty=False):
+class _TuningLeaderboard:
+    """
+    Keeps track of the best tunings found so far, following exactly the rules (including how ties are treated)
+    of the original exhaustive loop in rationalize_scale, so that any search that offers it the relevant tunings
+    in product order ends up with the same result.
+    """
+
+    def __init__(self, num_to_return=None):
+        self.num_to_return = num_to_return
+        # if num_to_return = n >= 1, this is a heap of the best n entries, each of which goes
+        # (-inharmonicity, -order, tuning), so that the worst leader is always on top. Among equally inharmonic
+        # tunings the one offered last counts as worst, just like with a stable sort.
+        # otherwise, if num_to_return is None, we just keep a list of the best tunings, each having
+        # least_tuning_inharmonicity
+        self.best_tunings = []
+        # only used if we are just returning the best tuning(s)
+        self.least_tuning_inharmonicity = float("inf")
+        self.num_considered = 0
+        # how many times the leaderboard has changed, so that anyone watching can tell when there's news
+        self.num_updates = 0
+
+    def consider(self, tuning, tuning_inharmonicity):
+        self.num_considered += 1
+        if self.num_to_return is not None:
+            # we want to get the best num_to_return tunings returned
+            entry = (-tuning_inharmonicity, -self.num_considered, tuning)
+            if len(self.best_tunings) < self.num_to_return:
+                # if we haven't even collected enough tunings to return yet, just add this one in
+                heapq.heappush(self.best_tunings, entry)
+                self.num_updates += 1
+            elif tuning_inharmonicity < -self.best_tunings[0][0]:
+                # otherwise, see if it's good enough to make the leaderboard by checking it with the worst leader
+                heapq.heapreplace(self.best_tunings, entry)
+                self.num_updates += 1
+        else:
+            # if num_to_return is None (the default), we just return the best, though we
+            # return multiple possibilities if more than one best exists
+            if tuning_inharmonicity < self.least_tuning_inharmonicity - 0.0001:
+                # if this is the best one so far (by more than just float rounding error)
+                self.best_tunings = [tuning]
+                self.least_tuning_inharmonicity = tuning_inharmonicity
+                self.num_updates += 1
+            elif abs(tuning_inharmonicity - self.least_tuning_inharmonicity) < 0.0001:
+                # if this is identical to the best so far (within float rounding error)
+                self.best_tunings.append(tuning)
+                self.num_updates += 1
+
+    def get_threshold(self):
+        # a tuning whose inharmonicity is at least this much cannot change the leaderboard
+        if self.num_to_return is not None:
+            if len(self.best_tunings) < self.num_to_return:
+                return float("inf")
+            return -self.best_tunings[0][0]
+        else:
+            return self.least_tuning_inharmonicity + 0.0001
+
+    def get_leaders(self):
+        # the (tuning, inharmonicity) pairs on the leaderboard, from best to worst
+        if self.num_to_return is not None:
+            return [(tuning, -negative_inharmonicity)
+                    for negative_inharmonicity, _, tuning in sorted(self.best_tunings, reverse=True)]
+        else:
+            return [(tuning, self.least_tuning_inharmonicity) for tuning in self.best_tunings]
+
+    def get_results(self, num_degrees, write_pretty=False):
+        # in the same form as rationalize_scale returns them (or None if nothing has been considered yet)
+        if len(self.best_tunings) == 0:
+            return None
+
+        def make_returnable(tuning):
+            return [str(t[0]) + "/" + str(t[1]) for t in tuning] if write_pretty else tuning
+
+        if self.num_to_return is not None:
+            return [(make_returnable(x), num_degrees * (num_degrees - 1) / y) for (x, y) in self.get_leaders()]
+        else:
+            specific_harmonicity = num_degrees * (num_degrees - 1) / self.least_tuning_inharmonicity
+            if len(self.best_tunings) > 1:
+                return [make_returnable(x) for x in self.best_tunings], specific_harmonicity
+            else:
+                return make_returnable(self.best_tunings[0]), specific_harmonicity
+
+
+class _ShardLeaderboard(_TuningLeaderboard):
+    """
+    The leaderboard kept by a worker process searching one shard of the tuning product. Besides its own
+    leaderboard, it keeps (in product order) every tuning that could matter to the leaderboard of the whole search,
+    so that the parent process can replay them into a _TuningLeaderboard and get exactly the result that a single
+    search would have given.
+    """
+
+    # When just returning the best tuning(s), the leaderboard at any point is within the tie tolerance (0.0001) of
+    # the least inharmonicity seen so far, and the whole search has seen at least as much as this shard has. So
+    # anything that matters to the whole search is within twice the tie tolerance of this shard's leader (plus a
+    # little extra for rounding)
+    relevance_margin = 0.00021
+
+    def __init__(self, num_to_return=None, known_threshold=float("inf")):
+        _TuningLeaderboard.__init__(self, num_to_return)
+        # the threshold of the whole search's leaderboard as it stood before this shard, if known. It only gets
+        # stricter as the search goes on, so nothing at or above it can matter.
+        self.known_threshold = known_threshold
+        self.relevant_tunings = []
+
+    def consider(self, tuning, tuning_inharmonicity):
+        if self.num_to_return is None and tuning_inharmonicity < self.get_threshold():
+            self.relevant_tunings.append((tuning, tuning_inharmonicity))
+        _TuningLeaderboard.consider(self, tuning, tuning_inharmonicity)
+
+    def get_threshold(self):
+        if self.num_to_return is not None:
+            return min(_TuningLeaderboard.get_threshold(self), self.known_threshold)
+        else:
+            return min(self.least_tuning_inharmonicity + self.relevance_margin, self.known_threshold)
+
+    def get_relevant_tunings(self):
+        if self.num_to_return is not None:
+            # the global top n has to be made up of the local top n's; we return them in the order they were found
+            return [(tuning, -negative_inharmonicity)
+                    for negative_inharmonicity, _, tuning in sorted(self.best_tunings, key=lambda x: -x[1])]
+        else:
+            return self.relevant_tunings
+
+
+def get_pairwise_inharmonicity_table(candidates):
+    """
+    Precomputes the inharmonicity of every interval that can come up when choosing one candidate per scale degree.
+
+    :param candidates: a list, for each scale degree, of candidate ratios for that degree
+    :return: a numpy array where table[i, a, j, b] is the inharmonicity of the interval between candidate a for
+        scale degree i and candidate b for scale degree j. Degrees with fewer candidates than the others are padded
+        out with infinite inharmonicity.
+    """
+    num_degrees = len(candidates)
+    max_candidates = max(len(degree_candidates) for degree_candidates in candidates)
+    table = np.full((num_degrees, max_candidates, num_degrees, max_candidates), float("inf"))
+    for i in range(num_degrees):
+        table[i, :len(candidates[i]), i, :len(candidates[i])] = 0
+    # the same intervals come up over and over between different pairs of degrees
+    interval_inharmonicities = {}
+    for i, j in itertools.combinations(range(num_degrees), 2):
+        for a, ratio_a in enumerate(candidates[i]):
+            for b, ratio_b in enumerate(candidates[j]):
+                interval = Fraction(ratio_a[1]*ratio_b[0], ratio_a[0]*ratio_b[1])
+                if interval not in interval_inharmonicities:
+                    interval_inharmonicities[interval] = get_interval_inharmonicity(ratio_a, ratio_b)
+                table[i, a, j, b] = table[j, b, i, a] = interval_inharmonicities[interval]
+    return table
+
+
+def get_tuning_inharmonicities(table, candidate_indices):
+    """
+    Scores a whole batch of tunings at once.
+
+    :param table: a table from get_pairwise_inharmonicity_table
+    :param candidate_indices: an integer array of shape (number of tunings, number of scale degrees), each row
+        of which gives the index of the candidate chosen for each degree
+    :return: an array with the inharmonicity of each tuning, exactly as get_tuning_inharmonicity would give it
+    """
+    candidate_indices = np.asarray(candidate_indices)
+    total_inharmonicities = np.zeros(len(candidate_indices))
+    # adding up the intervals in the same order as get_tuning_inharmonicity means the floating point results match
+    for i, j in itertools.combinations(range(candidate_indices.shape[1]), 2):
+        total_inharmonicities += table[i, candidate_indices[:, i], j, candidate_indices[:, j]]
+    return total_inharmonicities
+
+
+def _exhaustive_search(candidates, leaderboard, table, batch_size=10000):
+    """
+    Scores every tuning in the product of the candidates, a batch at a time, and offers the ones that could
+    change the leaderboard to it in product order. Returns the number of tunings checked.
+    """
+    candidate_counts = [len(degree_candidates) for degree_candidates in candidates]
+    number_of_tunings = reduce(lambda a, b: a*b, candidate_counts)
+    tunings_checked = 0
+    for batch_start in range(0, number_of_tunings, batch_size):
+        batch = np.arange(batch_start, min(batch_start + batch_size, number_of_tunings))
+        # unravel_index in C order enumerates the tunings in the same order as itertools.product
+        candidate_indices = np.column_stack(np.unravel_index(batch, candidate_counts))
+        tuning_inharmonicities = get_tuning_inharmonicities(table, candidate_indices)
+        # the threshold only gets stricter, so anything failing it now will never matter
+        for k in np.flatnonzero(tuning_inharmonicities < leaderboard.get_threshold()):
+            leaderboard.consider(tuple(candidates[i][a] for i, a in enumerate(candidate_indices[k])),
+                                 float(tuning_inharmonicities[k]))
+        tunings_checked += len(batch)
+        print tunings_checked, "tunings checked"
+    return tunings_checked
+
+
+def _summarize_table(table):
+    # the things the branch and bound needs from the table besides the table itself
+    num_degrees = table.shape[0]
+    pairs = list(itertools.combinations(range(num_degrees), 2))
+    # plain python floats are quicker to add up one at a time than numpy scalars
+    table_values = table.tolist()
+    # a lower bound on the inharmonicity of the intervals among the degrees from depth d onwards
+    pair_minimums = table.min(axis=(1, 3))
+    among_remaining_bound = [sum(pair_minimums[i, j] for (i, j) in pairs if i >= depth)
+                             for depth in range(num_degrees + 1)]
+    return table_values, among_remaining_bound
+
+
+def _iter_branch_and_bound(candidates, leaderboard, table, prefix=(), table_summary=None, report_interval=1000):
+    """
+    Depth-first search through the product of the candidates, choosing one scale degree at a time, that abandons
+    any partial tuning whose intervals are already too inharmonic to change the leaderboard. Complete tunings are
+    offered to the leaderboard in the same order as itertools.product would produce them, and their inharmonicity
+    is summed in the same order as get_tuning_inharmonicity, so the result is identical to the exhaustive search.
+    If a prefix of candidate indices is given, only the tunings starting with those choices are searched. The
+    table_summary can be passed in when searching with the same table many times.
+
+    This is a generator, so that the search can be paused and abandoned: it yields the number of complete tunings
+    checked so far every time the leaderboard changes, and otherwise once every report_interval choices tried.
+    """
+    num_degrees = len(candidates)
+    candidate_counts = [len(degree_candidates) for degree_candidates in candidates]
+    pairs = list(itertools.combinations(range(num_degrees), 2))
+    table_values, among_remaining_bound = _summarize_table(table) if table_summary is None else table_summary
+
+    choice = list(prefix) + [0] * (num_degrees - len(prefix))
+    tunings_checked = 0
+    choices_tried = 0
+
+    partial_inharmonicity = 0
+    # accumulated[j, b] is the total inharmonicity of the intervals between the degrees chosen so far and
+    # candidate b for degree j. It lets us score each new choice incrementally, and bound the rest.
+    accumulated = np.zeros(table.shape[2:])
+    for depth, a in enumerate(prefix):
+        partial_inharmonicity += accumulated[depth, a]
+        accumulated = accumulated + table[depth, a]
+
+    # each entry on the stack goes [depth, partial_inharmonicity, accumulated, next candidate to try at this depth]
+    stack = [[len(prefix), partial_inharmonicity, accumulated, 0]]
+    while len(stack) > 0:
+        frame = stack[-1]
+        depth, partial_inharmonicity, accumulated, a = frame
+
+        if depth == num_degrees:
+            stack.pop()
+            total_inharmonicity = 0
+            for i, j in pairs:
+                total_inharmonicity += table_values[i][choice[i]][j][choice[j]]
+            num_updates = leaderboard.num_updates
+            leaderboard.consider(tuple(candidates[i][a] for i, a in enumerate(choice)), total_inharmonicity)
+            tunings_checked += 1
+            if leaderboard.num_updates != num_updates:
+                yield tunings_checked
+            continue
+
+        if a >= candidate_counts[depth]:
+            stack.pop()
+            continue
+        frame[3] = a + 1
+
+        choices_tried += 1
+        if choices_tried % report_interval == 0:
+            yield tunings_checked
+
+        this_partial_inharmonicity = partial_inharmonicity + accumulated[depth, a]
+        this_accumulated = accumulated + table[depth, a]
+        # each degree still to be chosen has to form intervals with the ones chosen so far
+        lower_bound = this_partial_inharmonicity + among_remaining_bound[depth + 1] + \
+            this_accumulated[depth + 1:].min(axis=1).sum()
+        # the partial sum is added up in a different order from the total, so we allow a little slack
+        # for floating point error before abandoning the branch
+        threshold = leaderboard.get_threshold()
+        if lower_bound > threshold + 1e-9 * abs(threshold):
+            continue
+        choice[depth] = a
+        stack.append([depth + 1, this_partial_inharmonicity, this_accumulated, 0])
+
+
+def _branch_and_bound(candidates, leaderboard, table, prefix=(), table_summary=None):
+    # runs the whole search (see _iter_branch_and_bound) and returns the number of complete tunings checked
+    num_considered_before = leaderboard.num_considered
+    for _ in _iter_branch_and_bound(candidates, leaderboard, table, prefix, table_summary):
+        pass
+    return leaderboard.num_considered - num_considered_before
+
+
+# set up in each worker process by _initialize_shard_worker, so that the candidates and table are only sent once
+_shard_search_setup = None
+
+
+def _initialize_shard_worker(candidates, table, num_to_return, known_threshold):
+    global _shard_search_setup
+    _shard_search_setup = candidates, table, _summarize_table(table), num_to_return, known_threshold
+
+
+def _search_shard(prefix):
+    # runs in a worker process; searches the tunings that start with the given prefix
+    candidates, table, table_summary, num_to_return, known_threshold = _shard_search_setup
+    shard_leaderboard = _ShardLeaderboard(num_to_return, known_threshold)
+    tunings_checked = _branch_and_bound(candidates, shard_leaderboard, table, prefix, table_summary)
+    return shard_leaderboard.get_relevant_tunings(), tunings_checked
+
+
+def _get_shard_prefixes(candidate_counts, min_num_shards):
+    # splits up the product into the shortest prefixes that make at least min_num_shards shards, in product order
+    prefix_length = 0
+    num_shards = 1
+    while num_shards < min_num_shards and prefix_length < len(candidate_counts):
+        num_shards *= candidate_counts[prefix_length]
+        prefix_length += 1
+    return list(itertools.product(*[range(count) for count in candidate_counts[:prefix_length]]))
+
+
+def _parallel_branch_and_bound(candidates, leaderboard, table, workers):
+    """
+    Splits the product of the candidates into shards by their first few choices, and runs the branch and bound
+    on each shard in a pool of worker processes. The tunings from each shard that could matter are then replayed
+    into the leaderboard in product order, which gives exactly the same result as a single search.
+    Returns the number of complete tunings that were checked.
+    """
+    # several shards per worker, since some shards get pruned much more than others
+    shard_prefixes = _get_shard_prefixes([len(degree_candidates) for degree_candidates in candidates], 4 * workers)
+    # the first shard is made of everyone's favorite candidates, so we search it here first. That way the other
+    # shards start out knowing roughly how good a tuning needs to be, instead of each starting from scratch.
+    first_shard_leaderboard = _ShardLeaderboard(leaderboard.num_to_return)
+    tunings_checked = _branch_and_bound(candidates, first_shard_leaderboard, table, shard_prefixes[0])
+    for tuning, tuning_inharmonicity in first_shard_leaderboard.get_relevant_tunings():
+        leaderboard.consider(tuning, tuning_inharmonicity)
+    # (with a little slack for rounding, since the leaderboard checks ties a slightly different way)
+    known_threshold = leaderboard.get_threshold() + 1e-9 * abs(leaderboard.get_threshold())
+
+    pool = multiprocessing.Pool(workers, _initialize_shard_worker,
+                                (candidates, table, leaderboard.num_to_return, known_threshold))
+    try:
+        for relevant_tunings, shard_tunings_checked in pool.imap(_search_shard, shard_prefixes[1:]):
+            for tuning, tuning_inharmonicity in relevant_tunings:
+                leaderboard.consider(tuning, tuning_inharmonicity)
+            tunings_checked += shard_tunings_checked
+    finally:
+        pool.close()
+        pool.join()
+    return tunings_checked
+
+
+def _get_scale_degree_candidates(cents_values, nominal_tolerance, min_harmonicity, num_candidates, verbose=False):
+    candidates = []
+    for i, cent_value in enumerate(cents_values):
+        if verbose:
+            print "  ...for scale degree", i+1
+        candidates.append(get_ratio_candidates(cent_value, nominal_tolerance, min_harmonicity, num_candidates))
+    if any(len(degree_candidates) == 0 for degree_candidates in candidates):
+        raise Exception("No available candidates for some scale degrees")
+    return candidates
+
+
+def rationalize_scale(cents_values, nominal_tolerance, min_harmonicity, num_candidates, num_to_return=None,
+                      write_pretty=False, prune=True, workers=None):
     """
 
     :param cents_values: An array of cent values for the pitches of the scale, all in reference to a distance from
@@ -254,66 +884,104 @@ def rationalize_scale(cents_values, nominal_tolerance, min_harmonicity, num_cand
     :param num_to_return: if None, we just return the best tuning (or a list of equally best tunings) and the
         specific harmonicity. If a number n, we return a list of the top n tunings as ordered pairs (tuning, harmonicity)
     :param write_pretty: if True, it returns a list fraction strings (easier to read); if false, a list of tuples
+    :param prune: if True, we use a branch and bound search that skips over partial tunings that are already too
+        inharmonic to make the cut; if False, we compare every possible tuning. The results are the same either way.
+    :param workers: if a number greater than 1, the branch and bound search is split up across that many processes.
+        The results are the same as with a single process.
     """
-    candidates = []
     print "Generating Candidates..."
-    for i, cent_value in enumerate(cents_values):
-        print "  ...for scale degree", i+1
-        candidates.append(get_ratio_candidates(cent_value, nominal_tolerance, min_harmonicity, num_candidates))
-
+    candidates = _get_scale_degree_candidates(cents_values, nominal_tolerance, min_harmonicity, num_candidates,
+                                              verbose=True)
     number_of_tunings = reduce(lambda a, b: a*b, map(len, candidates))
-    if number_of_tunings == 0:
-        raise Exception("No available candidates for some scale degrees")
+
+    # every interval that can come up is scored once up front
+    table = get_pairwise_inharmonicity_table(candidates)
+    leaderboard = _TuningLeaderboard(num_to_return)
+    if prune:
+        print "Searching", number_of_tunings, "possible tunings..."
+        if workers is not None and workers > 1:
+            tunings_checked = _parallel_branch_and_bound(candidates, leaderboard, table, workers)
+        else:
+            tunings_checked = _branch_and_bound(candidates, leaderboard, table)
+        print tunings_checked, "tunings checked"
     else:
         print "Comparing all", number_of_tunings, "possible tunings..."
-    # keeps a list of the best tunings (as long as the num_to_return)
-    # each entry goes (tuning, inharmonicity) if num_to_return = n >= 1
-    # otherwise, if num_to_return is None, we just keep a list of the best tunings, each having least_tuning_inharmonicity
-    best_tunings = []
-    # only used if we are just returning the best tuning(s)
-    least_tuning_inharmonicity = float("inf")
-    tunings_checked = 0
-    for tuning_choice in itertools.product(*candidates):
-        tuning_inharmonicity = get_tuning_inharmonicity(tuning_choice)
-        returnable_tuning = [str(t[0]) + "/" + str(t[1]) for t in tuning_choice] if write_pretty else tuning_choice
-        if num_to_return is not None:
-            # we want to get the best num_to_return tunings returned
-            if len(best_tunings) < num_to_return:
-                # if we haven't even collected enough tunings to return yet, just add this one in
-                best_tunings.append((returnable_tuning, tuning_inharmonicity))
-                # then sort based on inharmonicity
-                best_tunings.sort(key=lambda x: x[1])
-            else:
-                # otherwise, see if it's good enough to make the leaderboard by checking it with the worst leader
-                if tuning_inharmonicity < best_tunings[-1][1]:
-                    best_tunings.append((returnable_tuning, tuning_inharmonicity))
-                    best_tunings.sort(key=lambda x: x[1])
-                    best_tunings.pop()
-        else:
-            # if num_to_return is None (the default), we just return the best, though we
-            # return multiple possibilities if more than one best exists
-            if tuning_inharmonicity < least_tuning_inharmonicity - 0.0001:
-                # if this is the best one so far (by more than just float rounding error)
-                best_tunings = [returnable_tuning]
-                least_tuning_inharmonicity = tuning_inharmonicity
-            elif abs(tuning_inharmonicity - least_tuning_inharmonicity) < 0.0001:
-                # if this is identical to the best so far (within float rounding error)
-                best_tunings.append(returnable_tuning)
+        _exhaustive_search(candidates, leaderboard, table)
 
-        tunings_checked += 1
-        if tunings_checked % 1000 == 0:
-            print tunings_checked, "tunings checked"
+    return leaderboard.get_results(len(cents_values), write_pretty)
 
-    if num_to_return is not None:
-        return [(x, len(cents_values) * (len(cents_values) - 1) / y) for (x, y) in best_tunings]
-    else:
-        specific_harmonicity = len(cents_values) * (len(cents_values) - 1) / least_tuning_inharmonicity
-        if len(best_tunings) > 1:
-            return best_tunings, specific_harmonicity
-        else:
-            return best_tunings[0], specific_harmonicity
 
 
+class RationalizationProgress:
+    """
+    A snapshot of a scale rationalization in progress, as yielded by iter_rationalize_scale.
+
+    results: the best so far, in the same form that rationalize_scale returns (None if nothing has been checked)
+    improved: whether results have changed since the last snapshot
+    tunings_checked: the number of complete tunings checked so far
+    number_of_tunings: the total number of possible tunings
+    elapsed_time: seconds since the search started
+    is_complete: True on the last snapshot if the search ran to the end, in which case results are exactly what
+        rationalize_scale would have returned
+    stop_reason: on the last snapshot, one of "complete", "time_budget", "max_evaluations" or "cancelled"
+    """
+
+    def __init__(self, results, improved, tunings_checked, number_of_tunings, elapsed_time, stop_reason=None):
+        self.results = results
+        self.improved = improved
+        self.tunings_checked = tunings_checked
+        self.number_of_tunings = number_of_tunings
+        self.elapsed_time = elapsed_time
+        self.stop_reason = stop_reason
+        self.is_complete = stop_reason == "complete"
+
+    def __repr__(self):
+        return "RationalizationProgress [tunings_checked=" + str(self.tunings_checked) + "/" + \
+               str(self.number_of_tunings) + ", elapsed_time=" + str(self.elapsed_time) + \
+               ", stop_reason=" + str(self.stop_reason) + ", results=" + str(self.results) + "]"
+
+
+def iter_rationalize_scale(cents_values, nominal_tolerance, min_harmonicity, num_candidates, num_to_return=None,
+                           write_pretty=False, time_budget=None, max_evaluations=None, cancel_event=None,
+                           report_interval=1000):
+    """
+    A version of rationalize_scale (using the branch and bound search) that yields RationalizationProgress
+    snapshots as it goes: one every time the best tunings so far change, and otherwise one every so often so that
+    the caller can keep an eye on things. The last snapshot has a stop_reason saying why the search ended.
+
+    Other than the ones below, the parameters are the same as for rationalize_scale.
+    :param time_budget: if given, the search stops after this many seconds
+    :param max_evaluations: if given, the search stops after checking this many complete tunings
+    :param cancel_event: if given, something like a threading.Event; the search stops once it is set. (Simply
+        closing the generator, or no longer iterating it, also stops the search.)
+    :param report_interval: how many choices are tried between snapshots when nothing is improving
+    """
+    start_time = time.time()
+    candidates = _get_scale_degree_candidates(cents_values, nominal_tolerance, min_harmonicity, num_candidates)
+    number_of_tunings = reduce(lambda a, b: a*b, map(len, candidates))
+    table = get_pairwise_inharmonicity_table(candidates)
+    leaderboard = _TuningLeaderboard(num_to_return)
+
+    def take_snapshot(tunings_checked, stop_reason=None):
+        improved = leaderboard.num_updates != take_snapshot.num_updates
+        take_snapshot.num_updates = leaderboard.num_updates
+        return RationalizationProgress(leaderboard.get_results(len(cents_values), write_pretty), improved,
+                                       tunings_checked, number_of_tunings, time.time() - start_time, stop_reason)
+    take_snapshot.num_updates = 0
+
+    for tunings_checked in _iter_branch_and_bound(candidates, leaderboard, table, report_interval=report_interval):
+        if cancel_event is not None and cancel_event.is_set():
+            yield take_snapshot(tunings_checked, "cancelled")
+            return
+        if time_budget is not None and time.time() - start_time >= time_budget:
+            yield take_snapshot(tunings_checked, "time_budget")
+            return
+        if max_evaluations is not None and tunings_checked >= max_evaluations:
+            yield take_snapshot(tunings_checked, "max_evaluations")
+            return
+        yield take_snapshot(tunings_checked)
+    yield take_snapshot(leaderboard.num_considered, "complete")
+
 
 # EXAMPLES!
 
@@ -395,38 +1063,62 @@ def _first_order_backward_beat_priorities(length):
 
 
 def _get_backward_beat_priorities(*args):
+    return _get_backward_beat_priority_array(*args).tolist()
+
+
+def _get_backward_beat_priority_array(*args):
+    # same as _get_backward_beat_priorities, but built up with numpy broadcasting instead of itertools.product
     strata_backward_beat_priorities = []
     for meter_stratum in args:
         strata_backward_beat_priorities.append(_first_order_backward_beat_priorities(meter_stratum))
     # we reverse the strata here, because the position in the lowest level stratum matters the most
     strata_backward_beat_priorities.reverse()
 
-    strata_lengths = [len(x) for x in strata_backward_beat_priorities]
+    # the first stratum varies slowest, just like in itertools.product, and each stratum's priorities get
+    # multiplied by the product of the lengths of the strata before it
+    overall_beat_priorities = np.zeros(1, dtype=np.int64)
+    multiplier = 1
+    for stratum_priorities in strata_backward_beat_priorities:
+        stratum_priorities = np.array(stratum_priorities, dtype=np.int64) * multiplier
+        overall_beat_priorities = (overall_beat_priorities[:, np.newaxis] + stratum_priorities[np.newaxis, :]).ravel()
+        multiplier *= len(stratum_priorities)
 
-    strata_multipliers = [1]
-    last_multiplier = 1
-    for l in strata_lengths[:-1]:
-        last_multiplier *= l
-        strata_multipliers.append(last_multiplier)
+    return overall_beat_priorities
 
-    overall_beat_priorities = []
-    for combination in itertools.product(*strata_backward_beat_priorities):
-        overall_beat_priorities.append(sum(p*q for p, q in zip(combination, strata_multipliers)))
 
-    return overall_beat_priorities
+# below this many pulses, it's quicker to work out the indispensabilities than to load them from the disk cache
+_min_pulses_to_cache_on_disk = 1000
 
 
-def get_indispensability_array(rhythmic_strata, normalize=False):
-    backward_beat_priorities = _get_backward_beat_priorities(*rhythmic_strata)
+def _get_indispensability_ndarray(rhythmic_strata):
+    # the (unnormalized) indispensabilities as an int64 numpy array
+    num_pulses = reduce(lambda a, b: a*b, [sum(x) if hasattr(x, "__len__") else x for x in rhythmic_strata], 1)
+    cache_key = tuple(tuple(x) if hasattr(x, "__len__") else x for x in rhythmic_strata)
+    use_disk_cache = num_pulses >= _min_pulses_to_cache_on_disk
+    cached_arrays = _load_from_disk_cache("indispensability", cache_key) if use_disk_cache else None
+    if cached_arrays is not None:
+        return cached_arrays["indispensabilities"]
+
+    backward_beat_priorities = _get_backward_beat_priority_array(*rhythmic_strata)
     length = len(backward_beat_priorities)
-    backward_indispensability_array = [length-1-backward_beat_priorities.index(i) for i in range(length)]
-    indispensability_array = rotate(backward_indispensability_array, 1)
-    indispensability_array.reverse()
+    # the priorities are a permutation of range(length), so rather than searching for each pulse with .index(),
+    # we can invert the permutation in one go: position_in_priorities[p] is where p shows up in the priorities
+    position_in_priorities = np.empty(length, dtype=np.int64)
+    position_in_priorities[backward_beat_priorities] = np.arange(length, dtype=np.int64)
+    backward_indispensability_array = length - 1 - position_in_priorities
+    # rotate by one and then reverse, just as in the list version
+    indispensability_array = np.roll(backward_indispensability_array, -1)[::-1].copy()
+    if use_disk_cache:
+        _save_to_disk_cache("indispensability", cache_key, {"indispensabilities": indispensability_array})
+    return indispensability_array
+
+
+def get_indispensability_array(rhythmic_strata, normalize=False):
+    indispensability_array = _get_indispensability_ndarray(rhythmic_strata)
     if normalize:
-        max_val = max(indispensability_array)
-        return [float(x)/max_val for x in indispensability_array]
+        return (indispensability_array / float(indispensability_array.max())).tolist()
     else:
-        return indispensability_array
+        return indispensability_array.tolist()
 
 
 def decompose_to_twos_and_threes(n):
@@ -507,13 +1199,89 @@ def calculate_metric_similarity(rhythmic_strata_away, bar_tempo_away, rhythmic_s
     return cross_coherence / auto_coherence
 
 
+def _get_meter_key(rhythmic_strata):
+    return tuple(tuple(x) if hasattr(x, "__len__") else x for x in rhythmic_strata)
+
+
+def get_metric_coherence_matrix(meters, standard_barlow=True):
+    """
+    Calculates the metric coherence of every pair of meters at once.
+    :param meters: a list of (rhythmic_strata, bar_tempo) tuples
+    :param standard_barlow: as in calculate_metric_coherence
+    :return: a symmetric numpy array, where entry [i, j] is the coherence between meters i and j (agrees with
+    calculate_metric_coherence up to floating point rounding). Pairs for which calculate_metric_coherence would
+    raise a math domain error come out as nan, rather than spoiling the whole matrix.
+    """
+    pulse_tempos = [_get_num_pulses_in_meter(rhythmic_strata) * bar_tempo for rhythmic_strata, bar_tempo in meters]
+    meter_keys = [_get_meter_key(rhythmic_strata) for rhythmic_strata, _ in meters]
+
+    # the squared, normalized indispensabilities of a meter subdivided by a given factor. Lots of pairs end up
+    # needing the same subdivision of the same meter, so we hold on to these
+    squared_indispensabilities = {}
+    # sums of those squares over each residue class mod some number (see below)
+    residue_sums = {}
+
+    def get_residue_sums(which_meter, subdivision, modulus):
+        key = (meter_keys[which_meter], subdivision, modulus)
+        if key not in residue_sums:
+            array_key = (meter_keys[which_meter], subdivision)
+            if array_key not in squared_indispensabilities:
+                subdivided_strata = list(meters[which_meter][0]) + sorted(prime_factor(subdivision), reverse=True)
+                if standard_barlow:
+                    subdivided_strata = standardize_strata(subdivided_strata)
+                indispensabilities = _get_indispensability_ndarray(subdivided_strata)
+                indispensabilities = indispensabilities / float(indispensabilities.max())
+                squared_indispensabilities[array_key] = indispensabilities ** 2
+            squares = squared_indispensabilities[array_key]
+            residue_sums[key] = squares.reshape(-1, modulus).sum(axis=0)
+        return residue_sums[key]
+
+    average_product_squared = np.empty((len(meters), len(meters)))
+    for i in range(len(meters)):
+        for j in range(i, len(meters)):
+            shared_tempo = lcm(pulse_tempos[i], pulse_tempos[j])
+            subdivision_i = shared_tempo / pulse_tempos[i]
+            subdivision_j = shared_tempo / pulse_tempos[j]
+            length_i = _get_num_pulses_in_meter(meters[i][0]) * subdivision_i
+            length_j = _get_num_pulses_in_meter(meters[j][0]) * subdivision_j
+            # rather than tiling both arrays out to the joint pattern length, note that over that length, pulse k
+            # lines up index k % length_i with index k % length_j, and that (by the Chinese remainder theorem) this
+            # hits every pair of indices that agree mod gcd(length_i, length_j) exactly once. So the sum of the
+            # squared products is just a dot product of the sums over each residue class.
+            modulus = gcd(length_i, length_j)
+            sum_of_product_squares = np.dot(get_residue_sums(i, subdivision_i, modulus),
+                                            get_residue_sums(j, subdivision_j, modulus))
+            average_product_squared[i][j] = average_product_squared[j][i] = \
+                sum_of_product_squares / lcm(length_i, length_j)
+
+    # the mysteriously scaled value, as in calculate_metric_coherence
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -1/(2*np.log((9*average_product_squared - 1) / 3.5))
+
+
+def get_metric_similarity_matrix(meters, standard_barlow=True):
+    """
+    Calculates the metric similarity of every pair of meters at once.
+    :param meters: a list of (rhythmic_strata, bar_tempo) tuples
+    :param standard_barlow: as in calculate_metric_similarity
+    :return: a numpy array, where entry [i, j] is the similarity of "away" meter i to "home" meter j
+    """
+    coherence_matrix = get_metric_coherence_matrix(meters, standard_barlow)
+    # each column gets divided by the auto-coherence of its home meter
+    return coherence_matrix / np.diag(coherence_matrix)[np.newaxis, :]
+
+
 # ------------------------------------------------- Other ---------------------------------------------------
 
 # from Terhardt. Chosen for ease of inverse calculation
 def freq_to_bark(f):
+    if hasattr(f, "__len__"):
+        return 13.3 * np.arctan(0.75*np.asarray(f, dtype=float)/1000.0)
     return 13.3 * math.atan(0.75*f/1000.0)
 
 
 # the inverse formula
 def bark_to_freq(b):
+    if hasattr(b, "__len__"):
+        return np.tan(np.asarray(b, dtype=float)/13.3)*1000.0/0.75
     return math.tan(b/13.3)*1000.0/0.75
\ No newline at end of file
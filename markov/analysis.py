@@ -1,6 +1,6 @@
 __author__ = 'mpevans'
 
-from marcpy.utilities import cyclic_slice
+from marcpy.utilities import iter_sliding_windows
 
 from pykov import *
 
@@ -86,18 +86,13 @@ class AnalysisSynthesisChain(Chain):
         if order >= len(self.data):
             order = len(self.data)
 
-        for o in range(1, order+1):
-            if self.cyclic:
-                start_indices = range(len(self.data))
+        # each window of size o+1 is an antecedent of order o followed by its consequent
+        for window in iter_sliding_windows(self.data, order + 1, min_size=2, cyclic=self.cyclic):
+            this_key = (window[:-1], window[-1])
+            if this_key in self:
+                self[this_key] += 1
             else:
-                start_indices = range(len(self.data) - o)
-
-            for i in start_indices:
-                this_key = (tuple(cyclic_slice(self.data, i, i+o)), self.data[(i+o) % len(self.data)])
-                if this_key in self.keys():
-                    self[this_key] += 1
-                else:
-                    self[this_key] = 1
+                self[this_key] = 1
 
         # this part is necessary to normalize the probabilities
         antecedent_total_prob_values = {}
@@ -37,7 +37,8 @@ class OneDParamEditor(MarcPaintWidget):
 
     @classmethod
     def new_from_file(cls, file_path, window_size=(700, 400)):
-        data, data_range, param_name = load_object(file_path)
+        # (a binary parameter file is mapped copy-on-write, so edits stay in memory until saved)
+        data, data_range, param_name = load_param_file(file_path, mmap_mode="c")
         return cls(data, data_range, window_size=window_size, param_name=param_name, current_file=file_path)
 
     def animate(self, dt):
@@ -102,11 +103,11 @@ class OneDParamEditor(MarcPaintWidget):
         if key == 83 and "meta" in modifiers:
             # command-s
             if self.current_file is not None and "shift" not in modifiers:
-                save_object((self.array_data, self.data_range, self.param_name), self.current_file)
+                save_param_file(self.array_data, self.data_range, self.param_name, self.current_file)
             else:
                 path = os.path.dirname(__file__)
                 filename = QtWidgets.QFileDialog.getSaveFileName(QtWidgets.QFileDialog(), 'Save Array', path)[0]
-                save_object((self.array_data, self.data_range, self.param_name), filename)
+                save_param_file(self.array_data, self.data_range, self.param_name, filename)
         if key == 82 and "meta" in modifiers:
             # command-r changes range
             low, high = do_var_setter_dialog([{"description": "Low:",
@@ -1,11 +1,13 @@
 __author__ = 'mpevans'
 
 from marcpy import utilities
+import numpy as np
 
 class OneDParamReader:
 
     def __init__(self, filepath):
-        self.array_data, self.data_range, self.param_name = utilities.load_object(filepath)
+        # binary parameter files are memory-mapped, so only the parts of the array we actually read get loaded
+        self.array_data, self.data_range, self.param_name = utilities.load_param_file(filepath)
 
     def get_array_value_at_percent(self, percent, power=1, cyclic=False):
         index = float(percent) * len(self.array_data)
@@ -14,6 +16,18 @@ class OneDParamReader:
     def get_interpolated_array_value(self, index, power=1, cyclic=False):
         return utilities.get_interpolated_array_value(self.array_data, index, power=power, cyclic=cyclic)
 
+    def get_array_values_at_percents(self, percents, power=1, cyclic=False):
+        indices = np.asarray(percents, dtype=float) * len(self.array_data)
+        return utilities.get_interpolated_array_values(self.array_data, indices, power=power, cyclic=cyclic)
+
+    def get_interpolated_array_values(self, indices, power=1, cyclic=False):
+        return utilities.get_interpolated_array_values(self.array_data, indices, power=power, cyclic=cyclic)
+
+    def get_control_rate_values(self, duration, control_rate, power=1, cyclic=False):
+        # one value per control tick, for a parameter stretched over the given duration (in seconds)
+        num_samples = int(round(duration * control_rate))
+        return utilities.get_resampled_array(self.array_data, num_samples, power=power, cyclic=cyclic)
+
     def get_name(self):
         return self.param_name
 
@@ -0,0 +1,142 @@
+__author__ = 'mpevans'
+
+import numpy as np
+from marcpy.utilities import get_interval_cycle_distance, get_pitch_class_description
+
+# Pitch class sets are represented here as 12-bit integers ("masks"), with bit k set if pitch class k is in the set.
+# So {0, 4, 7} is 1 + 16 + 128 = 145. Every operation on sets is then a lookup into one of the tables below, which
+# are all worked out once, when the module loads, for all 4096 possible sets. The batch functions take (and return)
+# numpy arrays of masks of any shape, so millions of sets can be handled without looping in python.
+
+_num_sets = 4096
+_all_masks = np.arange(_num_sets, dtype=np.int64)
+
+# ---------------------------------------------- Conversion -------------------------------------------------
+
+
+def pc_set_to_mask(pc_set):
+    mask = 0
+    for pc in pc_set:
+        mask |= 1 << (int(pc) % 12)
+    return mask
+
+
+def mask_to_pc_set(mask):
+    return tuple(pc for pc in range(12) if mask >> pc & 1)
+
+
+def pc_sets_to_masks(pc_sets):
+    # batch version of pc_set_to_mask; returns an array of masks
+    return np.array([pc_set_to_mask(pc_set) for pc_set in pc_sets], dtype=np.int64)
+
+
+def get_pc_set_description(mask, accidental_type="standard"):
+    return "{" + ", ".join(_pc_names[accidental_type][pc] for pc in mask_to_pc_set(mask)) + "}"
+
+
+_pc_names = {accidental_type: [get_pitch_class_description(pc, accidental_type) for pc in range(12)]
+             for accidental_type in ("standard", "sharp", "flat", "both")}
+
+# ---------------------------------------------- Tables -------------------------------------------------
+
+
+def _get_transposition_table():
+    # _transposition_table[mask, n] is the mask transposed up by n semitones
+    table = np.empty((_num_sets, 12), dtype=np.int64)
+    for n in range(12):
+        table[:, n] = ((_all_masks << n) | (_all_masks >> (12 - n))) & 0xFFF
+    return table
+
+
+def _get_inversion_table():
+    # _inversion_table[mask] is the mask inverted around pitch class 0 (pc goes to -pc)
+    table = np.zeros(_num_sets, dtype=np.int64)
+    for pc in range(12):
+        table |= ((_all_masks >> pc) & 1) << ((12 - pc) % 12)
+    return table
+
+
+_transposition_table = _get_transposition_table()
+_inversion_table = _get_inversion_table()
+_cardinality_table = sum((_all_masks >> pc) & 1 for pc in range(12))
+
+# the prime form of a set is the smallest mask among all of its transpositions and inversions. Comparing masks as
+# integers compares their highest pitch classes first, so this is the one most packed to the left, i.e. Rahn's
+# prime form (which differs from Forte's for a handful of set classes)
+_prime_form_table = np.minimum(_transposition_table.min(axis=1),
+                               _transposition_table[_inversion_table].min(axis=1))
+
+# interval class vectors: the number of pairs in the set a given interval class apart
+_interval_class_vector_table = np.empty((_num_sets, 6), dtype=np.int64)
+for _interval_class in range(1, 7):
+    _interval_class_vector_table[:, _interval_class - 1] = \
+        _cardinality_table[_all_masks & _transposition_table[:, _interval_class]]
+# (a tritone is its own inversion, so each tritone pair got counted twice)
+_interval_class_vector_table[:, 5] //= 2
+
+
+def _get_interval_cycle_distance_tables():
+    # _interval_cycle_distance_tables[cycle_size][pc1, pc2] is utilities.get_interval_cycle_distance(pc1, pc2,
+    # cycle_size), for every cycle size from 0 to 11 (only the cycle size mod 12 matters)
+    tables = np.empty((12, 12, 12), dtype=np.int64)
+    for cycle_size in range(12):
+        for pc1 in range(12):
+            for pc2 in range(12):
+                tables[cycle_size, pc1, pc2] = get_interval_cycle_distance(pc1, pc2, cycle_size)
+    return tables
+
+
+_interval_cycle_distance_tables = _get_interval_cycle_distance_tables()
+
+# ---------------------------------------------- Batch Operations -------------------------------------------------
+
+
+def transpose(masks, n):
+    return _transposition_table[masks, np.mod(n, 12)]
+
+
+def invert(masks):
+    return _inversion_table[masks]
+
+
+def get_cardinalities(masks):
+    return _cardinality_table[masks]
+
+
+def get_prime_forms(masks):
+    # the set-class normal form, as a mask (so that two sets are in the same set class iff their prime forms match)
+    return _prime_form_table[masks]
+
+
+def get_interval_class_vectors(masks):
+    # an array with an extra last axis of length 6
+    return _interval_class_vector_table[masks]
+
+
+def get_all_transpositions_and_inversions(masks):
+    # an array with an extra last axis of length 24: T0 to T11 followed by T0I to T11I
+    return np.concatenate([_transposition_table[masks], _transposition_table[_inversion_table[masks]]], axis=-1)
+
+
+def get_common_tone_counts(masks_1, masks_2):
+    return _cardinality_table[np.bitwise_and(masks_1, masks_2)]
+
+
+def get_hamming_distances(masks_1, masks_2):
+    # the number of pitch classes in one set but not the other
+    return _cardinality_table[np.bitwise_xor(masks_1, masks_2)]
+
+
+def get_interval_class_vector_distances(masks_1, masks_2):
+    # city-block distance between interval class vectors; zero for sets with the same intervallic content
+    return np.abs(_interval_class_vector_table[masks_1] - _interval_class_vector_table[masks_2]).sum(axis=-1)
+
+
+def get_interval_cycle_distances(pcs_1, pcs_2, cycle_size):
+    # batch version of utilities.get_interval_cycle_distance, for arrays of pitch classes
+    return _interval_cycle_distance_tables[np.mod(cycle_size, 12), np.mod(pcs_1, 12), np.mod(pcs_2, 12)]
+
+
+def get_interval_cycle_distance_table(cycle_size):
+    # the full 12x12 table of interval cycle distances for the given cycle size
+    return _interval_cycle_distance_tables[cycle_size % 12].copy()
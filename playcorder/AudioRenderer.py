@@ -0,0 +1,133 @@
+__author__ = 'mpevans'
+
+import wave
+import os
+import numpy as np
+
+import localfluidsynth
+from VoiceAllocator import VoiceAllocator
+
+
+def render_parts_to_wav(parts, soundfont_path, file_path, presets=None, samplerate=44100, gain=0.2,
+                        channels_per_part=16, release_time=2.0, block_size=4096, write_buffer_size=262144):
+    """
+    Renders recorded parts to a stereo 16-bit WAV file, through a fluidsynth synth with no audio driver, so it works
+    with no sound card, and much faster than realtime. Audio is generated in blocks between note events, each event
+    landing at its exact sample position (fluidsynth itself applies events on its internal 64-sample boundaries).
+    :param parts: a list of PlaycorderInstruments, each with a recording (a list of MPNotes)
+    :param soundfont_path: the soundfont to render with
+    :param file_path: where to save the WAV file
+    :param presets: optional dictionary of part name -> preset (an int for bank 0, or a (bank, preset) tuple). Parts
+    not in it use their own preset if they're midi parts, and otherwise bank 0, preset 0.
+    :param samplerate: the sample rate of the output
+    :param gain: the synth gain
+    :param channels_per_part: the maximum number of simultaneous notes in each part
+    :param release_time: how long to keep rendering after the last note ends, to let it ring out
+    :param block_size: the maximum number of frames generated by each call to the synth
+    :param write_buffer_size: how many frames are collected before each write to the file
+    """
+    presets = {} if presets is None else presets
+    synth = localfluidsynth.Synth(gain=gain, samplerate=samplerate)
+    try:
+        soundfont_id = synth.sfload(soundfont_path)
+        events = []
+        for part_num, part in enumerate(parts):
+            preset = presets.get(part.name, getattr(part, "bank_and_preset", (0, 0)))
+            bank, preset = (0, preset) if isinstance(preset, int) else preset
+            for channel in range(part_num * channels_per_part, (part_num + 1) * channels_per_part):
+                synth.program_select(channel, soundfont_id, bank, preset)
+            for note_num, note in enumerate(part.recording):
+                start_frame = int(round(note.start_time * samplerate))
+                end_frame = int(round((note.start_time + note.length) * samplerate))
+                if end_frame <= start_frame:
+                    # a note too short to last even a sample (e.g. started and ended at the same manual time) can't
+                    # be heard, and would otherwise have its end sorted before its start
+                    continue
+                # at the same frame, note ends go before note starts, so that a repeated note gets restruck
+                events.append((start_frame, 1, part_num, note_num, note))
+                events.append((end_frame, 0, part_num, note_num, note))
+        events.sort(key=lambda event: event[:4])
+
+        voice_allocators = [VoiceAllocator(range(part_num * channels_per_part, (part_num + 1) * channels_per_part))
+                            for part_num in range(len(parts))]
+        voices = {}   # (part_num, note_num) -> the Voice sounding that note
+        # render to a temporary file and only move it into place once it's complete, so that a failed render
+        # doesn't leave a truncated WAV file behind
+        temp_file_path = file_path + ".tmp"
+        writer = _BufferedWaveWriter(temp_file_path, samplerate, write_buffer_size)
+        try:
+            try:
+                frames_rendered = 0
+                for frame, is_start, part_num, note_num, note in events:
+                    if frame > frames_rendered:
+                        _render_frames(synth, writer, frame - frames_rendered, block_size)
+                        frames_rendered = frame
+                    if is_start:
+                        int_pitch = int(round(note.pitch))
+                        voice, stolen_voice = voice_allocators[part_num].allocate(int_pitch, note.volume)
+                        if stolen_voice is not None:
+                            synth.noteoff(stolen_voice.channel, stolen_voice.pitch)
+                        synth.pitch_bend(voice.channel, int((note.pitch - int_pitch)*2048))
+                        synth.noteon(voice.channel, int_pitch, int(note.volume*127))
+                        voices[(part_num, note_num)] = voice
+                    else:
+                        voice = voices.pop((part_num, note_num))
+                        if voice_allocators[part_num].release(voice.channel, voice.voice_number):
+                            synth.noteoff(voice.channel, voice.pitch)
+                _render_frames(synth, writer, int(round(release_time * samplerate)), block_size)
+            finally:
+                writer.close()
+        except:
+            os.remove(temp_file_path)
+            raise
+        if os.name == "nt" and os.path.exists(file_path):
+            os.remove(file_path)
+        os.rename(temp_file_path, file_path)
+    finally:
+        synth.delete()
+
+
+def _render_frames(synth, writer, num_frames, block_size):
+    # generates num_frames frames of audio from the synth, a block at a time, straight into the writer's buffer
+    frames_left = num_frames
+    while frames_left > 0:
+        free_space = writer.get_free_space(min(frames_left, block_size))
+        synth.get_samples_into(free_space)
+        writer.advance(len(free_space) // 2)
+        frames_left -= len(free_space) // 2
+
+
+class _BufferedWaveWriter:
+    """
+    Collects interleaved stereo 16-bit samples in a preallocated buffer, and writes them to the WAV file in large
+    chunks, rather than a little bit at a time. The synth renders directly into the buffer: get_free_space gives a
+    view of the next unused part of it, and advance marks frames as filled.
+    """
+
+    def __init__(self, file_path, samplerate, buffer_size):
+        self.wave_file = wave.open(file_path, "wb")
+        self.wave_file.setnchannels(2)
+        self.wave_file.setsampwidth(2)
+        self.wave_file.setframerate(samplerate)
+        self.buffer = np.empty(buffer_size * 2, dtype=np.int16)
+        self.buffer_position = 0
+
+    def get_free_space(self, max_frames):
+        # a view of (up to) the next max_frames frames of the buffer, which is never empty, since a full buffer gets
+        # written out straight away
+        num_samples = min(max_frames * 2, len(self.buffer) - self.buffer_position)
+        return self.buffer[self.buffer_position:self.buffer_position + num_samples]
+
+    def advance(self, num_frames):
+        self.buffer_position += num_frames * 2
+        if self.buffer_position == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if self.buffer_position > 0:
+            self.wave_file.writeframes(self.buffer[:self.buffer_position].tostring())
+            self.buffer_position = 0
+
+    def close(self):
+        self.flush()
+        self.wave_file.close()
@@ -0,0 +1,210 @@
+__author__ = 'mpevans'
+
+import threading
+import heapq
+import itertools
+import time
+import traceback
+import os
+import select
+import sys
+import ctypes
+import ctypes.util
+
+
+class _MachTimebaseInfo(ctypes.Structure):
+    _fields_ = [("numer", ctypes.c_uint32), ("denom", ctypes.c_uint32)]
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1
+
+
+def _get_monotonic_clock():
+    # A clock that only ever moves forward at a steady rate, so that if the system clock gets adjusted (e.g. by NTP)
+    # pending events don't all fire early or late. Python 3 has time.monotonic; in python 2 we go to the system for
+    # it: mach_absolute_time on OS X, clock_gettime(CLOCK_MONOTONIC) elsewhere. time.time is the last resort.
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        if sys.platform == "darwin":
+            libc = ctypes.CDLL(ctypes.util.find_library("c"))
+            libc.mach_absolute_time.restype = ctypes.c_uint64
+            timebase_info = _MachTimebaseInfo()
+            if libc.mach_timebase_info(ctypes.byref(timebase_info)) != 0:
+                return time.time
+            seconds_per_tick = float(timebase_info.numer) / timebase_info.denom / 1e9
+
+            def mach_clock():
+                return libc.mach_absolute_time() * seconds_per_tick
+            return mach_clock
+        else:
+            # (clock_gettime lives in librt in older versions of glibc)
+            library_path = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+            clock_gettime = ctypes.CDLL(library_path, use_errno=True).clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+            clock_gettime.restype = ctypes.c_int
+
+            def posix_clock():
+                timespec = _Timespec()
+                if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+                    raise OSError(ctypes.get_errno(), "clock_gettime failed")
+                return timespec.tv_sec + timespec.tv_nsec * 1e-9
+            # (make sure it actually works before relying on it)
+            posix_clock()
+            return posix_clock
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+
+monotonic_clock = _get_monotonic_clock()
+
+
+class EventScheduler:
+    """
+    Carries out timed events (like note ons and offs) from a single thread, rather than having a thread per note
+    that sleeps until it's needed. Events are kept in a heap ordered by when they're due, and each is given an
+    absolute due time, so that lateness in carrying out one event never pushes back the ones after it.
+    The thread waits for the next event in select, on a pipe that schedule_at writes to whenever a new event becomes the
+    earliest one, so it wakes up promptly either way. (A timed threading.Condition.wait would do, except that in python
+    2 it's a polling loop that can be up to 50ms late to notice a notify.)
+    A virtual scheduler has no thread and no connection to real time: its clock only moves when advance or advance_to
+    is called, at which point all the events that have come due are carried out straight away, in order.
+    """
+
+    def __init__(self, clock=None, virtual=False):
+        """
+        :param clock: a function returning the current time in seconds (defaults to a monotonic clock)
+        :param virtual: if True, time is logical, starting at zero and moved forward by advance / advance_to
+        """
+        self.virtual = virtual
+        self.virtual_time = 0.0
+        if virtual:
+            self.clock = self._get_virtual_time
+        else:
+            self.clock = monotonic_clock if clock is None else clock
+        self._events = []   # heap entries go (due_time, event_number, function, args)
+        self._event_numbers = itertools.count()
+        self._cancelled_events = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        # the scheduling thread is woken up by writing a byte to this pipe (only ever one at a time, so that the
+        # pipe can never fill up and block)
+        self._wakeup_pipe = None
+        self._wakeup_pending = False
+        # timing statistics
+        self.events_run = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def get_time(self):
+        return self.clock()
+
+    def schedule_at(self, due_time, function, *args):
+        # schedules function(*args) to be called at due_time (on this scheduler's clock); returns an event number,
+        # which can be used to cancel the event
+        with self._lock:
+            event_number = next(self._event_numbers)
+            heapq.heappush(self._events, (due_time, event_number, function, args))
+            if self.virtual:
+                return event_number
+            if self._thread is None:
+                self._wakeup_pipe = os.pipe()
+                self._thread = threading.Thread(target=self._run, name="EventScheduler")
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._events[0][1] == event_number and not self._wakeup_pending:
+                # the new event is the next one due, so the thread needs to stop waiting for the old next one
+                os.write(self._wakeup_pipe[1], b"x")
+                self._wakeup_pending = True
+        return event_number
+
+    def schedule(self, delay, function, *args):
+        # schedules function(*args) to be called after the given delay in seconds
+        return self.schedule_at(self.clock() + delay, function, *args)
+
+    def cancel(self, event_number):
+        with self._lock:
+            if any(event[1] == event_number for event in self._events):
+                self._cancelled_events.add(event_number)
+
+    def num_pending_events(self):
+        with self._lock:
+            return len(self._events) - len(self._cancelled_events)
+
+    def get_timing_stats(self):
+        return {"events_run": self.events_run, "max_lateness": self.max_lateness,
+                "average_lateness": self.total_lateness / self.events_run if self.events_run > 0 else 0.0}
+
+    def advance(self, seconds):
+        # virtual mode only: moves the clock forward by the given number of seconds, carrying out any events on the way
+        self.advance_to(self.virtual_time + seconds)
+
+    def advance_to(self, new_time):
+        # virtual mode only: moves the clock forward to new_time, carrying out any events on the way. While each event
+        # is being carried out, the clock reads that event's due time, so anything it schedules is timed from there.
+        assert self.virtual, "Only a virtual scheduler can be advanced"
+        while True:
+            with self._lock:
+                if len(self._events) == 0 or self._events[0][0] > new_time:
+                    break
+                due_time, event_number, function, args = heapq.heappop(self._events)
+                if event_number in self._cancelled_events:
+                    self._cancelled_events.remove(event_number)
+                    continue
+                self.virtual_time = max(self.virtual_time, due_time)
+            self.events_run += 1
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+        self.virtual_time = max(self.virtual_time, new_time)
+
+    def _get_virtual_time(self):
+        return self.virtual_time
+
+    def _run(self):
+        wakeup_pipe_out = self._wakeup_pipe[0]
+        while True:
+            with self._lock:
+                time_left = self._events[0][0] - self.clock() if len(self._events) > 0 else None
+                if time_left is None or time_left > 0:
+                    due_time = None
+                else:
+                    due_time, event_number, function, args = heapq.heappop(self._events)
+                    if event_number in self._cancelled_events:
+                        self._cancelled_events.remove(event_number)
+                        continue
+
+            if due_time is None:
+                # wait until the next event is due (or indefinitely, if there isn't one), unless woken up because
+                # an earlier event has been scheduled, in which case we go round again
+                if len(select.select([wakeup_pipe_out], [], [], time_left)[0]) > 0:
+                    with self._lock:
+                        os.read(wakeup_pipe_out, 1)
+                        self._wakeup_pending = False
+                continue
+
+            lateness = self.clock() - due_time
+            self.events_run += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            try:
+                function(*args)
+            except Exception:
+                # one bad event shouldn't bring down all future playback
+                traceback.print_exc()
+
+
+_shared_scheduler = None
+
+
+def get_shared_scheduler():
+    # the scheduler used by default by all playcorders and instruments
+    global _shared_scheduler
+    if _shared_scheduler is None:
+        _shared_scheduler = EventScheduler()
+    return _shared_scheduler
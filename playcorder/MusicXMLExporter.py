@@ -7,6 +7,7 @@ from datetime import date
 import numbers
 import random
 import re
+import numpy as np
 
 #  -------------------------------------------------- GLOBALS ----------------------------------------------------- #
 
@@ -48,6 +49,26 @@ def get_pitch_step_alter_and_octave(pitch, accidental_preference="standard"):
     return step, alteration, octave, rounded_pitch
 
 
+def get_pitch_steps_alters_and_octaves(pitches, accidental_preference="standard"):
+    """
+    Batch version of get_pitch_step_alter_and_octave.
+    :param pitches: an array (or list) of midi pitches
+    :param accidental_preference: as in get_pitch_step_alter_and_octave
+    :return: numpy arrays of steps, alterations, octaves and rounded pitches, each the same shape as pitches
+    """
+    pitches = np.asarray(pitches, dtype=float)
+    # generated material uses few distinct pitches, so we spell each one once and spread the results back out
+    distinct_pitches, which_pitch = np.unique(pitches, return_inverse=True)
+    steps, alterations, octaves, rounded_pitches = [], [], [], []
+    for p in distinct_pitches.tolist():
+        step, alteration, octave, rounded_pitch = get_pitch_step_alter_and_octave(p, accidental_preference)
+        steps.append(step)
+        alterations.append(alteration)
+        octaves.append(octave)
+        rounded_pitches.append(rounded_pitch)
+    return tuple(np.array(x)[which_pitch].reshape(pitches.shape) for x in (steps, alterations, octaves, rounded_pitches))
+
+
 class Pitch(ET.Element):
 
     def __init__(self, midi_val, accidental_preference="standard"):
@@ -0,0 +1,70 @@
+__author__ = 'mpevans'
+
+import threading
+import itertools
+from collections import OrderedDict, deque
+
+
+class NoteRegistry:
+    """
+    Keeps track of the notes an instrument has started, in the order they were started, and indexed by note id, so
+    that both ending a particular note and ending the oldest note are O(1). All operations are locked, since notes get
+    started and ended from different threads.
+    Each entry is a tuple whose first element is the note id. Ids needn't be unique (a silent instrument gives every
+    note id 0, for instance); in that case the oldest note with the id is the one that gets ended.
+    """
+
+    def __init__(self):
+        # registration number -> entry, oldest first
+        self._entries = OrderedDict()
+        # note id -> deque of registration numbers, oldest first
+        self._registration_numbers_by_id = {}
+        self._registration_numbers = itertools.count()
+        self.lock = threading.RLock()
+
+    def add(self, entry):
+        with self.lock:
+            registration_number = next(self._registration_numbers)
+            self._entries[registration_number] = entry
+            self._registration_numbers_by_id.setdefault(entry[0], deque()).append(registration_number)
+
+    def pop(self, note_id):
+        # removes and returns the (oldest) entry with the given note id, or None if there isn't one
+        with self.lock:
+            if note_id not in self._registration_numbers_by_id:
+                return None
+            registration_numbers = self._registration_numbers_by_id[note_id]
+            registration_number = registration_numbers.popleft()
+            if len(registration_numbers) == 0:
+                del self._registration_numbers_by_id[note_id]
+            return self._entries.pop(registration_number)
+
+    def pop_oldest(self):
+        # removes and returns the entry that was added longest ago, or None if there aren't any
+        with self.lock:
+            if len(self._entries) == 0:
+                return None
+            # the oldest entry overall is also the oldest with its id, so it's at the front of that id's deque
+            return self.pop(next(self._entries.itervalues())[0])
+
+    def pop_all(self):
+        # removes and returns all of the entries, oldest first
+        with self.lock:
+            entries = self._entries.values()
+            self._entries.clear()
+            self._registration_numbers_by_id.clear()
+            return entries
+
+    def get_entries(self):
+        # a snapshot of all the entries, oldest first
+        with self.lock:
+            return self._entries.values()
+
+    def __contains__(self, note_id):
+        return note_id in self._registration_numbers_by_id
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.get_entries())
@@ -442,6 +442,7 @@ def _break_into_ties(recording_in_seconds, beat_schemes):
 
     for beat_scheme in beat_schemes:
         beat_start_time = beat_scheme.start_time
+        splits = {}
         for i in range(len(recording_in_seconds)):
             this_pc_note = recording_in_seconds[i]
             if this_pc_note.start_time < beat_start_time < this_pc_note.start_time + this_pc_note.length:
@@ -452,8 +453,8 @@ def _break_into_ties(recording_in_seconds, beat_schemes):
                                     this_pc_note.pitch, this_pc_note.volume, this_pc_note.variant, first_half_tie)
                 second_half = MPNote(beat_start_time, this_pc_note.start_time + this_pc_note.length - beat_start_time,
                                      this_pc_note.pitch, this_pc_note.volume, this_pc_note.variant, second_half_tie)
-                recording_in_seconds[i] = [first_half, second_half]
-        recording_in_seconds = utilities.make_flat_list(recording_in_seconds, indivisible_type=MPNote)
+                splits[i] = [first_half, second_half]
+        utilities.splice_in_place(recording_in_seconds, splits)
 
     return recording_in_seconds
 
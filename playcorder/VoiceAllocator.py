@@ -0,0 +1,126 @@
+__author__ = 'mpevans'
+
+import threading
+import heapq
+import itertools
+from collections import OrderedDict, deque, namedtuple
+
+Voice = namedtuple("Voice", "channel pitch volume voice_number")
+
+
+class VoiceAllocator:
+    """
+    Keeps track of which channels are sounding which notes, so that a new note goes to a free channel when there is
+    one, and otherwise steals a channel according to the stealing policy:
+      "oldest": the note that has been sounding longest
+      "quietest": the note with the lowest volume (the oldest of these, if there's a tie)
+      "same-pitch": the oldest note with the same pitch, if there is one; otherwise the oldest note
+    Free channels are handed out in the order they were freed, which gives each note's release the longest possible
+    time to ring before its channel gets reused.
+    """
+
+    stealing_policies = ("oldest", "quietest", "same-pitch")
+
+    def __init__(self, channels, stealing_policy="oldest"):
+        assert stealing_policy in VoiceAllocator.stealing_policies
+        self.stealing_policy = stealing_policy
+        self.free_channels = deque(channels)
+        # channel -> Voice, in the order the voices started, so the oldest is always first
+        self.active_voices = OrderedDict()
+        # pitch -> OrderedDict of channel -> Voice, again oldest first
+        self.active_voices_by_pitch = {}
+        # for voices with a known end time: heap of (end_time, voice_number, channel)
+        self.end_times = []
+        # for the "quietest" policy: heap of (volume, voice_number, channel). Entries for voices that have ended are
+        # left in and skipped over when they come to the top, and cleared out whenever they outnumber the live ones
+        self.volumes = []
+        self.voice_numbers = itertools.count()
+        self.lock = threading.Lock()
+        # statistics
+        self.num_allocations = 0
+        self.num_steals = 0
+        self.peak_polyphony = 0
+
+    def allocate(self, pitch, volume, end_time=None):
+        """
+        Finds a channel for a new note.
+        :param pitch: the (integer) pitch of the note
+        :param volume: the volume of the note
+        :param end_time: if known, when the note will end; the voice is then freed automatically by release_finished
+        :return: a tuple of (the new Voice, the Voice that was stolen to make room for it, or None)
+        """
+        with self.lock:
+            if len(self.free_channels) > 0:
+                channel = self.free_channels.popleft()
+                stolen_voice = None
+            else:
+                stolen_voice = self._choose_voice_to_steal(pitch)
+                self._remove_voice(stolen_voice)
+                channel = stolen_voice.channel
+                self.num_steals += 1
+
+            voice = Voice(channel, pitch, volume, next(self.voice_numbers))
+            self.active_voices[channel] = voice
+            self.active_voices_by_pitch.setdefault(pitch, OrderedDict())[channel] = voice
+            if end_time is not None:
+                heapq.heappush(self.end_times, (end_time, voice.voice_number, channel))
+            if self.stealing_policy == "quietest":
+                heapq.heappush(self.volumes, (volume, voice.voice_number, channel))
+                if len(self.volumes) > 2 * len(self.active_voices):
+                    self.volumes = [entry for entry in self.volumes if self.is_active(entry[2], entry[1])]
+                    heapq.heapify(self.volumes)
+            self.num_allocations += 1
+            self.peak_polyphony = max(self.peak_polyphony, len(self.active_voices))
+            return voice, stolen_voice
+
+    def release(self, channel, voice_number):
+        # frees the channel, unless the voice has already been stolen or released; returns whether it was freed
+        with self.lock:
+            return self._release(channel, voice_number)
+
+    def release_many(self, channels_and_voice_numbers):
+        # like release, for a list of (channel, voice_number) pairs; returns a list of whether each was freed
+        with self.lock:
+            return [self._release(channel, voice_number) for channel, voice_number in channels_and_voice_numbers]
+
+    def release_finished(self, now):
+        # frees all voices whose end time has passed
+        with self.lock:
+            while len(self.end_times) > 0 and self.end_times[0][0] <= now:
+                _, voice_number, channel = heapq.heappop(self.end_times)
+                self._release(channel, voice_number)
+
+    def is_active(self, channel, voice_number):
+        voice = self.active_voices.get(channel)
+        return voice is not None and voice.voice_number == voice_number
+
+    def get_polyphony(self):
+        return len(self.active_voices)
+
+    def get_stats(self):
+        return {"allocations": self.num_allocations, "steals": self.num_steals,
+                "peak_polyphony": self.peak_polyphony, "polyphony": len(self.active_voices)}
+
+    def _release(self, channel, voice_number):
+        if not self.is_active(channel, voice_number):
+            return False
+        self._remove_voice(self.active_voices[channel])
+        self.free_channels.append(channel)
+        return True
+
+    def _remove_voice(self, voice):
+        del self.active_voices[voice.channel]
+        voices_with_pitch = self.active_voices_by_pitch[voice.pitch]
+        del voices_with_pitch[voice.channel]
+        if len(voices_with_pitch) == 0:
+            del self.active_voices_by_pitch[voice.pitch]
+
+    def _choose_voice_to_steal(self, pitch):
+        if self.stealing_policy == "quietest":
+            # (ties go to the lowest voice number, i.e. the oldest)
+            while not self.is_active(self.volumes[0][2], self.volumes[0][1]):
+                heapq.heappop(self.volumes)
+            return self.active_voices[self.volumes[0][2]]
+        if self.stealing_policy == "same-pitch" and pitch in self.active_voices_by_pitch:
+            return next(self.active_voices_by_pitch[pitch].itervalues())
+        return next(self.active_voices.itervalues())
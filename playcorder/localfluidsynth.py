@@ -24,6 +24,7 @@
 import ctypes
 from ctypes import *
 import os
+import threading
 
 
 _fl = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), "libfluidsynth.1.5.2.dylib"))
@@ -149,6 +150,89 @@ fluid_synth_write_s16 = cfunc('fluid_synth_write_s16', c_void_p,
                               ('roff', c_int, 1),
                               ('rincr', c_int, 1))
 
+fluid_synth_write_float = cfunc('fluid_synth_write_float', c_int,
+                                ('synth', c_void_p, 1),
+                                ('len', c_int, 1),
+                                ('lout', c_void_p, 1),
+                                ('loff', c_int, 1),
+                                ('lincr', c_int, 1),
+                                ('rout', c_void_p, 1),
+                                ('roff', c_int, 1),
+                                ('rincr', c_int, 1))
+
+
+# Sequencer functions, for scheduling events ahead of time. When the sequencer isn't using the system timer, its
+# clock is advanced by the synth as it renders audio, so events land at exact positions in the audio stream.
+new_fluid_sequencer2 = cfunc('new_fluid_sequencer2', c_void_p,
+                             ('use_system_timer', c_int, 1))
+
+delete_fluid_sequencer = cfunc('delete_fluid_sequencer', None,
+                               ('seq', c_void_p, 1))
+
+fluid_sequencer_register_fluidsynth = cfunc('fluid_sequencer_register_fluidsynth', c_short,
+                                            ('seq', c_void_p, 1),
+                                            ('synth', c_void_p, 1))
+
+fluid_sequencer_unregister_client = cfunc('fluid_sequencer_unregister_client', None,
+                                          ('seq', c_void_p, 1),
+                                          ('id', c_short, 1))
+
+fluid_sequencer_get_tick = cfunc('fluid_sequencer_get_tick', c_uint,
+                                 ('seq', c_void_p, 1))
+
+fluid_sequencer_set_time_scale = cfunc('fluid_sequencer_set_time_scale', None,
+                                       ('seq', c_void_p, 1),
+                                       ('scale', c_double, 1))
+
+fluid_sequencer_get_time_scale = cfunc('fluid_sequencer_get_time_scale', c_double,
+                                       ('seq', c_void_p, 1))
+
+fluid_sequencer_send_at = cfunc('fluid_sequencer_send_at', c_int,
+                                ('seq', c_void_p, 1),
+                                ('evt', c_void_p, 1),
+                                ('time', c_uint, 1),
+                                ('absolute', c_int, 1))
+
+fluid_sequencer_remove_events = cfunc('fluid_sequencer_remove_events', None,
+                                      ('seq', c_void_p, 1),
+                                      ('source', c_short, 1),
+                                      ('dest', c_short, 1),
+                                      ('type', c_int, 1))
+
+new_fluid_event = cfunc('new_fluid_event', c_void_p)
+
+delete_fluid_event = cfunc('delete_fluid_event', None,
+                           ('evt', c_void_p, 1))
+
+fluid_event_set_source = cfunc('fluid_event_set_source', None,
+                               ('evt', c_void_p, 1),
+                               ('src', c_short, 1))
+
+fluid_event_set_dest = cfunc('fluid_event_set_dest', None,
+                             ('evt', c_void_p, 1),
+                             ('dest', c_short, 1))
+
+fluid_event_noteon = cfunc('fluid_event_noteon', None,
+                           ('evt', c_void_p, 1),
+                           ('channel', c_int, 1),
+                           ('key', c_short, 1),
+                           ('vel', c_short, 1))
+
+fluid_event_noteoff = cfunc('fluid_event_noteoff', None,
+                            ('evt', c_void_p, 1),
+                            ('channel', c_int, 1),
+                            ('key', c_short, 1))
+
+fluid_event_pitch_bend = cfunc('fluid_event_pitch_bend', None,
+                               ('evt', c_void_p, 1),
+                               ('channel', c_int, 1),
+                               ('val', c_int, 1))
+
+fluid_event_control_change = cfunc('fluid_event_control_change', None,
+                                   ('evt', c_void_p, 1),
+                                   ('channel', c_int, 1),
+                                   ('control', c_short, 1),
+                                   ('val', c_short, 1))
 
 
 def fluid_synth_write_s16_stereo(synth, len):
@@ -158,9 +242,30 @@ def fluid_synth_write_s16_stereo(synth, len):
     
     """
     import numpy
-    buf = create_string_buffer(len * 4)
-    fluid_synth_write_s16(synth, len, buf, 0, 2, buf, 1, 2)
-    return numpy.fromstring(buf[:], dtype=numpy.int16)
+    return fluid_synth_write_stereo_into(synth, numpy.empty(len * 2, dtype=numpy.int16))
+
+
+def fluid_synth_write_stereo_into(synth, out):
+    """Write generated stereo samples directly into a Numpy array
+
+    The array must be contiguous, and either int16 (16-bit samples) or
+    float32 (floating point samples, with no conversion to 16-bit). It
+    is filled with len(out) / 2 frames of interleaved left and right
+    samples, through a pointer to its memory, so nothing is allocated
+    or copied. Returns the array.
+
+    """
+    import numpy
+    if not out.flags.c_contiguous:
+        raise ValueError("Output array must be contiguous")
+    if out.dtype == numpy.int16:
+        write_function = fluid_synth_write_s16
+    elif out.dtype == numpy.float32:
+        write_function = fluid_synth_write_float
+    else:
+        raise ValueError("Output array must be int16 or float32, not {}".format(out.dtype))
+    write_function(synth, out.size // 2, out.ctypes.data, 0, 2, out.ctypes.data, 1, 2)
+    return out
 
 
 # Object-oriented interface, simplifies access to functions
@@ -183,6 +288,7 @@ class Synth:
         fluid_settings_setint(st, 'synth.midi-channels', 256)
         self.settings = st
         self.synth = new_fluid_synth(st)
+        self.samplerate = samplerate
         self.audio_driver = None
     def start(self, driver=None):
         """Start audio output driver in separate background thread
@@ -285,6 +391,91 @@ class Synth:
 
         """
         return fluid_synth_write_s16_stereo(self.synth, len)
+    def get_float_samples(self, len=1024):
+        """Generate audio samples as 32-bit floats
+
+        Like get_samples, but the array is float32, straight from the
+        synth, without being converted to 16-bit.
+
+        """
+        import numpy
+        return fluid_synth_write_stereo_into(self.synth, numpy.empty(len * 2, dtype=numpy.float32))
+    def get_samples_into(self, out):
+        """Generate audio samples directly into an existing array
+
+        Fills a contiguous int16 or float32 Numpy array (for instance a
+        slice of a larger, preallocated buffer) with len(out) / 2 frames
+        of interleaved stereo samples, without allocating or copying.
+        Returns the array.
+
+        """
+        return fluid_synth_write_stereo_into(self.synth, out)
+
+class Sequencer:
+    """Sequencer schedules events for a Synth ahead of time, with timestamps in ticks"""
+    def __init__(self, synth, time_scale=1000.0, use_system_timer=False):
+        """Create a new sequencer feeding the given Synth
+
+        Optional keyword arguments:
+          time_scale : ticks per second, default is 1000 (i.e. milliseconds)
+          use_system_timer : if False (the default), the sequencer's clock is
+                 driven by the synth's audio rendering, so events are placed
+                 exactly in the output rather than whenever a timer fires
+
+        """
+        self.sequencer = new_fluid_sequencer2(1 if use_system_timer else 0)
+        fluid_sequencer_set_time_scale(self.sequencer, time_scale)
+        self.time_scale = fluid_sequencer_get_time_scale(self.sequencer)
+        self.synth_id = fluid_sequencer_register_fluidsynth(self.sequencer, synth.synth)
+        # the sequencer copies events when they are sent, so one event struct can be reused (under a lock)
+        self.event = new_fluid_event()
+        fluid_event_set_source(self.event, -1)
+        fluid_event_set_dest(self.event, self.synth_id)
+        self.lock = threading.Lock()
+    def delete(self):
+        delete_fluid_event(self.event)
+        fluid_sequencer_unregister_client(self.sequencer, self.synth_id)
+        delete_fluid_sequencer(self.sequencer)
+    def get_tick(self):
+        """Current time of the sequencer, in ticks"""
+        return fluid_sequencer_get_tick(self.sequencer)
+    def seconds_to_ticks(self, seconds):
+        return int(round(seconds * self.time_scale))
+    def _send_at(self, tick, absolute, source):
+        fluid_event_set_source(self.event, source)
+        return fluid_sequencer_send_at(self.sequencer, self.event, int(tick), 1 if absolute else 0)
+    def noteon_at(self, tick, chan, key, vel, absolute=True, source=-1):
+        """Schedule a note to start at the given tick
+
+        The source (any number from 0 to 32767, or -1 for none) tags the
+        event, so that it can later be cancelled with remove_events_from.
+        The other *_at methods take one as well.
+
+        """
+        with self.lock:
+            fluid_event_noteon(self.event, chan, key, vel)
+            return self._send_at(tick, absolute, source)
+    def noteoff_at(self, tick, chan, key, absolute=True, source=-1):
+        """Schedule a note to stop at the given tick"""
+        with self.lock:
+            fluid_event_noteoff(self.event, chan, key)
+            return self._send_at(tick, absolute, source)
+    def pitch_bend_at(self, tick, chan, val, absolute=True, source=-1):
+        """Schedule a pitch bend (same range as Synth.pitch_bend) at the given tick"""
+        with self.lock:
+            fluid_event_pitch_bend(self.event, chan, val + 8192)
+            return self._send_at(tick, absolute, source)
+    def cc_at(self, tick, chan, ctrl, val, absolute=True, source=-1):
+        """Schedule a control change at the given tick"""
+        with self.lock:
+            fluid_event_control_change(self.event, chan, ctrl, val)
+            return self._send_at(tick, absolute, source)
+    def remove_all_events(self):
+        """Throw away all events that haven't happened yet"""
+        fluid_sequencer_remove_events(self.sequencer, -1, -1, -1)
+    def remove_events_from(self, source):
+        """Throw away all events with the given source that haven't happened yet"""
+        fluid_sequencer_remove_events(self.sequencer, source, -1, -1)
 
 def raw_audio_string(data):
     """Return a string of bytes to send to soundcard
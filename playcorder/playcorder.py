@@ -1,12 +1,17 @@
 __author__ = 'mpevans'
 
 from fractions import Fraction
+import math
 
 import localfluidsynth
 from marcpy.chuck.chuck import *
 from MidiFile import MIDIFile
 from MeasuresBeatsNotes import *
 import RecordingToXML
+import AudioRenderer
+from EventScheduler import EventScheduler
+from VoiceAllocator import VoiceAllocator
+from NoteRegistry import NoteRegistry
 from threading import Event
 
 
@@ -17,26 +22,42 @@ from threading import Event
 
 class Playcorder:
 
-    def __init__(self, soundfont_path=None, channels_per_part=50):
+    def __init__(self, soundfont_path=None, channels_per_part=50, playback_lookahead=None, virtual_time=False):
         """
 
         :param soundfont_path: if we are using midi playback, the soundfont path
         :param channels_per_part: in fluidsynth midi playback,  each new note is played through a separate "channel".
         This sets the number of channels used by each instrument before recycling. Essentially a max # of voices.
+        :param playback_lookahead: if not None, notes played with play_note in fluidsynth midi playback are handed to
+        fluidsynth's sequencer (roughly) this many seconds before they are due, and timed by the synth itself as it
+        renders audio, rather than by python waking up at the right moment (so it must be positive)
+        :param virtual_time: if True, the playcorder runs faster than realtime: wait and register_time_passed move time
+        forward instantly (carrying out any scheduled note starts and ends on the way), and recording always uses
+        manual time. Recordings come out exactly the same as they would in real time, but fluidsynth isn't hooked up
+        to an audio driver, so there's nothing to hear.
         """
 
         # list of the current instruments used by this playcorder
         self.instruments = []
 
+        # all timed playback (note starts and ends) goes through this, rather than a thread per note
+        self.virtual_time = virtual_time
+        self.scheduler = EventScheduler(virtual=virtual_time)
+
         # --- MIDI setup, if necessary ---
         self.channels_per_part = channels_per_part
         self.used_channels = 0  # how many channels have we already assigned to various instruments
         self.synth = None
         self.soundfont_id = None  # the id of a loaded soundfont
+        if playback_lookahead is not None and playback_lookahead <= 0:
+            raise ValueError("playback_lookahead must be positive (or None, to play without the sequencer)")
+        self.playback_lookahead = playback_lookahead
+        self.sequencer = None  # only used for lookahead playback
         if soundfont_path is not None:
             if soundfont_path == "default":
                 soundfont_path = get_relative_file_path("LiteSoundFont.sf2")
             self.initialize_fluidsynth(soundfont_path)
+        self.soundfont_path = soundfont_path
 
         # construct a list of all the instruments available in the soundfont, for reference access
         self.instrument_list = None
@@ -60,6 +81,11 @@ class Playcorder:
         # loads the soundfont and gets the synth going
         self.synth = localfluidsynth.Synth()
         self.soundfont_id = self.synth.sfload(soundfont_path)
+        if self.virtual_time:
+            # no audio driver (and no sequencer, which would keep its own real time clock)
+            return
+        if self.playback_lookahead is not None:
+            self.sequencer = localfluidsynth.Sequencer(self.synth)
         self.synth.start()
 
     def get_instruments_with_substring(self, word):
@@ -74,10 +100,12 @@ class Playcorder:
         instrument.host_playcorder = self
         self.instruments.append(instrument)
 
-    def add_midi_part(self, preset, name=None):
+    def add_midi_part(self, preset, name=None, voice_stealing_policy="oldest"):
         """
         Constructs a MidiPlaycorderInstrument, adds it to the Playcorder, and returns it
         :param preset: if an int, assumes bank #0; can also be a tuple of form (bank, preset)
+        :param voice_stealing_policy: which sounding note gives up its channel when all of the part's channels are
+        busy: "oldest", "quietest" or "same-pitch" (see VoiceAllocator)
         :rtype : MidiPlaycorderInstrument
         """
         if self.synth is None:
@@ -89,11 +117,11 @@ class Playcorder:
         if isinstance(preset, int):
             # if just an int, assume bank 0 and that's the preset
             instrument = MidiPlaycorderInstrument(self.synth, self.soundfont_id, (0, preset), self.used_channels,
-                                                  self.channels_per_part, self, name)
+                                                  self.channels_per_part, self, name, voice_stealing_policy)
         else:
             # inst_num is a bank, preset pair
             instrument = MidiPlaycorderInstrument(self.synth, self.soundfont_id, preset, self.used_channels,
-                                                  self.channels_per_part, self, name)
+                                                  self.channels_per_part, self, name, voice_stealing_policy)
 
         self.used_channels += self.channels_per_part
         self.add_part(instrument)
@@ -132,7 +160,7 @@ class Playcorder:
                 return time.time()-self.recording_start_time
 
     def start_recording(self, which_parts=None, manual_time=False):
-        if manual_time:
+        if manual_time or self.virtual_time:
             self.time_passed = 0
         else:
             self.recording_start_time = time.time()
@@ -151,13 +179,18 @@ class Playcorder:
 
     # used for a situation where all parts are played from a single thread
     def wait(self, seconds):
-        time.sleep(seconds)
+        if self.virtual_time:
+            self.scheduler.advance(seconds)
+        else:
+            time.sleep(seconds)
         if self.time_passed is not None:
             self.time_passed += seconds
 
     # used for a situation where time is recorded manually, but there may be multiple threads,
     # only one of which registers time passed.
     def register_time_passed(self, seconds):
+        if self.virtual_time:
+            self.scheduler.advance(seconds)
         if self.time_passed is not None:
             self.time_passed += seconds
 
@@ -250,19 +283,39 @@ class Playcorder:
         bin_file.close()
 
 
+    # ---------------------------------------- SAVING TO WAV ----------------------------------------------
+
+    def save_to_wav_file(self, path, soundfont_path=None, presets=None, samplerate=44100, gain=0.2,
+                         release_time=2.0):
+        """
+        Renders the recorded parts offline to a WAV file (see AudioRenderer.render_parts_to_wav). Works without a sound
+        card, and runs much faster than realtime, so it goes well with virtual_time.
+        :param soundfont_path: defaults to the playcorder's own soundfont, or the default one if it doesn't have one
+        :param presets: optional dictionary of part name -> preset, for silent parts (or to override midi parts)
+        """
+        if soundfont_path is None:
+            soundfont_path = self.soundfont_path if self.soundfont_path is not None \
+                else get_relative_file_path("LiteSoundFont.sf2")
+        AudioRenderer.render_parts_to_wav(self.parts_recorded, soundfont_path, path, presets=presets,
+                                          samplerate=samplerate, gain=gain, channels_per_part=self.channels_per_part,
+                                          release_time=release_time)
+
+
 class PlaycorderInstrument:
 
     def __init__(self, host_playcorder=None, name=None):
         assert isinstance(host_playcorder, Playcorder)
         self.host_playcorder = host_playcorder
         self.name = name
-        self.notes_started = []   # each entry goes (note_id, pitch, volume, start_time, variant_dictionary)
+        self.notes_started = NoteRegistry()   # each entry goes (note_id, pitch, volume, start_time, variant_dictionary)
         self.render_info = {}
 
     # ------------------ Methods to be overridden by subclasses ------------------
 
     def _do_play_note(self, pitch, volume, length, start_delay, variant_dictionary):
         # Does the actual sonic implementation of playing a note
+        # this is called directly from play_note, so it should hand any timed events (like starting the note after
+        # start_delay) to self.host_playcorder.scheduler rather than sleeping
         pass
 
     def _do_start_note(self, pitch, volume, variant_dictionary=None):
@@ -274,6 +327,12 @@ class PlaycorderInstrument:
         # Does the actual sonic implementation of ending a the note with the given id
         pass
 
+    def _do_end_notes(self, note_ids):
+        # Does the actual sonic implementation of ending a whole batch of notes at once
+        # subclasses can override this if there's a quicker way than ending them one by one
+        for note_id in note_ids:
+            self._do_end_note(note_id)
+
     def change_note_pitch(self, note_id, new_pitch):
         # Changes the pitch of the note with the given id
         pass
@@ -281,8 +340,7 @@ class PlaycorderInstrument:
     # ------------------------- "Public" Playback Methods -------------------------
 
     def play_note(self, pitch, volume, length, start_delay=0, variant_dictionary=None, play_length=None):
-        thread.start_new_thread(self._do_play_note, (pitch, volume, length if play_length is None else play_length,
-                                                     start_delay, variant_dictionary))
+        self._do_play_note(pitch, volume, length if play_length is None else play_length, start_delay, variant_dictionary)
 
         # record the note in the hosting playcorder, if it's recording
         if self.host_playcorder and self.host_playcorder.get_time_passed() is not None:
@@ -291,39 +349,42 @@ class PlaycorderInstrument:
 
     def start_note(self, pitch, volume, variant_dictionary=None):
         note_id = self._do_start_note(pitch, volume, variant_dictionary)
-        self.notes_started.append((note_id, pitch, volume, self.host_playcorder.get_time_passed(), variant_dictionary))
+        self.notes_started.add((note_id, pitch, volume, self.host_playcorder.get_time_passed(), variant_dictionary))
         # returns the channel as a reference, in case we want to start and stop a bunch of these
         return note_id
 
     def end_note(self, note_id=None):
-        note_to_end = None
         if note_id is not None:
-            # find the note referred to in the notes_started list
-            for started_note in self.notes_started:
-                if started_note[0] == note_id:
-                    note_to_end = started_note
-                    break
-            if note_to_end is not None:
-                self.notes_started.remove(note_to_end)
-        elif len(self.notes_started) > 0:
+            note_to_end = self.notes_started.pop(note_id)
+        else:
             # if no note_id is specified, just end the note that has been going the longest
-            note_to_end = self.notes_started.pop(0)
+            note_to_end = self.notes_started.pop_oldest()
 
         if note_to_end is None:
             # no appropriate note has been found to end
             return
 
-        note_id, pitch, volume, start_time, variant_dictionary = note_to_end
         # call the specific implementation to stop the note
-        self._do_end_note(note_id)
-        # record the note in the hosting playcorder, if it's recording
-        if start_time is not None and self.host_playcorder.get_time_passed() is not None:
-            self.host_playcorder.record_note(self, pitch, volume, self.host_playcorder.get_time_passed()-start_time,
-                                             start_time=start_time, variant_dictionary=variant_dictionary)
+        self._do_end_note(note_to_end[0])
+        self._record_ended_notes([note_to_end])
 
     def end_all_notes(self):
-        while len(self.notes_started) > 0:
-            self.end_note()
+        # takes all the notes out of notes_started in one go, and ends them as a batch
+        notes_to_end = self.notes_started.pop_all()
+        if len(notes_to_end) == 0:
+            return
+        self._do_end_notes([started_note[0] for started_note in notes_to_end])
+        self._record_ended_notes(notes_to_end)
+
+    def _record_ended_notes(self, ended_notes):
+        # record the notes in the hosting playcorder, if it's recording
+        time_passed = self.host_playcorder.get_time_passed()
+        if time_passed is None:
+            return
+        for note_id, pitch, volume, start_time, variant_dictionary in ended_notes:
+            if start_time is not None:
+                self.host_playcorder.record_note(self, pitch, volume, time_passed-start_time,
+                                                 start_time=start_time, variant_dictionary=variant_dictionary)
 
     def num_notes_playing(self):
         return len(self.notes_started)
@@ -331,7 +392,8 @@ class PlaycorderInstrument:
 
 class MidiPlaycorderInstrument(PlaycorderInstrument):
 
-    def __init__(self, synth, soundfont_id, (bank, preset), start_channel, num_channels, host_playcorder=None, name=None):
+    def __init__(self, synth, soundfont_id, (bank, preset), start_channel, num_channels, host_playcorder=None, name=None,
+                 voice_stealing_policy="oldest"):
         assert isinstance(synth, localfluidsynth.Synth)
         assert isinstance(host_playcorder, Playcorder)
         PlaycorderInstrument.__init__(self, host_playcorder=host_playcorder, name=name)
@@ -344,36 +406,100 @@ class MidiPlaycorderInstrument(PlaycorderInstrument):
         for i in range(start_channel, start_channel + num_channels):
             synth.program_select(i, soundfont_id, bank, preset)
 
-        self.current_channel = 0
+        self.bank_and_preset = (bank, preset)
         self.start_channel = start_channel
         self.num_channels = num_channels
+        # keeps track of which of our channels are sounding, so that notes don't trample each other
+        self.voice_allocator = VoiceAllocator(range(start_channel, start_channel + num_channels), voice_stealing_policy)
 
     def _do_start_note(self, pitch, volume, variant_dictionary=None):
         # Does the actual sonic implementation of starting a note
-        # in this case the note_id returned will be a tuple consisting of the channel and the midi key pressed
-        channel = self.start_channel + self.current_channel
-        self.current_channel = (self.current_channel + 1) % self.num_channels
+        # in this case the note_id returned will be a tuple consisting of the channel, the midi key pressed, and the
+        # voice number given by the voice allocator (so we can tell if the channel has since been stolen)
         int_pitch = int(round(pitch))
+        voice, stolen_voice = self.voice_allocator.allocate(int_pitch, volume)
+        if stolen_voice is not None:
+            self.synth.noteon(stolen_voice.channel, stolen_voice.pitch, 0)
         pitch_bend_val = int((pitch - int_pitch)*2048)
-        self.synth.pitch_bend(channel, pitch_bend_val)
-        self.synth.noteon(channel, int_pitch, int(volume*127))
-        return channel, int_pitch
+        self.synth.pitch_bend(voice.channel, pitch_bend_val)
+        self.synth.noteon(voice.channel, int_pitch, int(volume*127))
+        return voice.channel, int_pitch, voice.voice_number
 
     def _do_end_note(self, note_id):
-        # Does the actual sonic implementation of ending a the note with the given note_id = channel, key pressed
-        channel, int_pitch = note_id
-        self.synth.noteon(channel, int_pitch, 0)
+        # Does the actual sonic implementation of ending a the note with the given note_id = channel, key pressed, voice
+        channel, int_pitch, voice_number = note_id
+        # if the channel got stolen by another note in the meantime, it's not ours to end
+        if self.voice_allocator.release(channel, voice_number):
+            self.synth.noteon(channel, int_pitch, 0)
+
+    def _do_end_notes(self, note_ids):
+        # frees all of the voices under one lock, then sends the note offs back to back
+        released = self.voice_allocator.release_many([(channel, voice_number)
+                                                      for channel, int_pitch, voice_number in note_ids])
+        for (channel, int_pitch, voice_number), was_released in zip(note_ids, released):
+            if was_released:
+                self.synth.noteon(channel, int_pitch, 0)
 
     def _do_play_note(self, pitch, volume, length, start_delay, variant_dictionary):
-        # Does the actual sonic implementation of playing a note
-        time.sleep(start_delay)
+        # Does the actual sonic implementation of playing a note, by scheduling its start (and through that its end)
+        if self.host_playcorder.sequencer is not None:
+            self._sequence_note(pitch, volume, length, start_delay)
+            return
+        scheduler = self.host_playcorder.scheduler
+        start_time = scheduler.get_time() + start_delay
+        scheduler.schedule_at(start_time, self._start_scheduled_note, pitch, volume, start_time + length,
+                              variant_dictionary)
+
+    def _start_scheduled_note(self, pitch, volume, end_time, variant_dictionary):
         note_id = self._do_start_note(pitch, volume, variant_dictionary)
-        time.sleep(length)
-        self._do_end_note(note_id)
+        # the end time was fixed when the note was scheduled, so if the start ran late the note doesn't get longer
+        self.host_playcorder.scheduler.schedule_at(end_time, self._do_end_note, note_id)
+
+    def _sequence_note(self, pitch, volume, length, start_delay):
+        # lookahead playback: the note's start and end ticks are pinned down now, against the sequencer's clock, but
+        # it only gets handed over once it's within the lookahead window. Hand-over times are rounded down to a grid
+        # of half the lookahead, so that notes close together in time get handed over in one go.
+        sequencer = self.host_playcorder.sequencer
+        scheduler = self.host_playcorder.scheduler
+        lookahead = self.host_playcorder.playback_lookahead
+        start_tick = sequencer.get_tick() + sequencer.seconds_to_ticks(start_delay)
+        end_tick = start_tick + sequencer.seconds_to_ticks(length)
+        now = scheduler.get_time()
+        hand_over_time = math.floor((now + start_delay - lookahead) / (lookahead / 2.0)) * (lookahead / 2.0)
+        if hand_over_time > now:
+            scheduler.schedule_at(hand_over_time, self._send_note_to_sequencer, pitch, volume, start_tick, end_tick)
+        else:
+            self._send_note_to_sequencer(pitch, volume, start_tick, end_tick)
+
+    def _send_note_to_sequencer(self, pitch, volume, start_tick, end_tick):
+        sequencer = self.host_playcorder.sequencer
+        # the sequencer ends these notes by itself, so the allocator frees their voices once their end tick has gone
+        # by (with a tick to spare, to be sure the note off has actually been carried out). That way, any events still
+        # waiting in the sequencer for a channel belong to the voice that currently has it.
+        self.voice_allocator.release_finished(sequencer.get_tick() - 1)
+        int_pitch = int(round(pitch))
+        voice, stolen_voice = self.voice_allocator.allocate(int_pitch, volume, end_time=end_tick)
+        if stolen_voice is not None:
+            # cancel whatever the stolen note still has queued (its note off, and maybe even its start), and cut it
+            # off when the new note comes in. The cut off isn't tagged with the channel, so that it survives in case
+            # the new note gets stolen in turn before it starts.
+            sequencer.remove_events_from(stolen_voice.channel)
+            sequencer.noteoff_at(start_tick, stolen_voice.channel, stolen_voice.pitch)
+        # the events for each note are tagged with its channel as their source, so they can be cancelled if stolen
+        sequencer.pitch_bend_at(start_tick, voice.channel, int((pitch - int_pitch)*2048), source=voice.channel)
+        sequencer.noteon_at(start_tick, voice.channel, int_pitch, int(volume*127), source=voice.channel)
+        sequencer.noteoff_at(end_tick, voice.channel, int_pitch, source=voice.channel)
+
+    def get_voice_stats(self):
+        # allocations, steals, peak polyphony and current polyphony
+        return self.voice_allocator.get_stats()
 
     def change_note_pitch(self, note_id, new_pitch):
         # Changes the pitch of the note started at channel
-        channel, int_pitch = note_id
+        channel, int_pitch, voice_number = note_id
+        if not self.voice_allocator.is_active(channel, voice_number):
+            # its channel has been stolen by another note, so bending it would bend that note instead
+            return
         pitch_bend_val = int((new_pitch - int_pitch) * 4096)
         # unfortunately there is a limit of -8192 to 8192 (or 4 half-steps up or down), so we confine it to this range
         pitch_bend_val = min(max(pitch_bend_val, -8192), 8191)
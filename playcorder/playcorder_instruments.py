@@ -1,6 +1,7 @@
 __author__ = 'mpevans'
 
 from playcorder import *
+from EventScheduler import get_shared_scheduler
 
 
 class ChuckPlaycorderInstrument:
@@ -80,8 +81,7 @@ class ChuckMultiSamplePlayer:
         self.path_dictionary = path_dictionary
         self.chuck_instrument = ChuckInstrument(get_relative_file_path("MultiSamplePlayer.ck"), chuck_args)
 
-    def play_note_thread(self, pitch, variant, volume, length, start_delay):
-        time.sleep(start_delay)
+    def send_play_message(self, pitch, variant, volume, length, start_delay):
         self.chuck_instrument.send_message(self.osc_message_address, [int(pitch), variant, float(volume),
                                                                               float(length), float(start_delay)])
 
@@ -90,8 +90,9 @@ class ChuckMultiSamplePlayer:
         if pitch in self.path_dictionary:
             if (not isinstance(self.path_dictionary[pitch], dict) and variant == "norm") \
                     or variant in self.path_dictionary[pitch]:
-                # it's playable
-                thread.start_new_thread(self.play_note_thread, (pitch, variant, volume, length, start_delay))
+                # it's playable, so have the message sent once the start delay is up
+                scheduler = self.host_playcorder.scheduler if self.host_playcorder else get_shared_scheduler()
+                scheduler.schedule(start_delay, self.send_play_message, pitch, variant, volume, length, start_delay)
 
         if self.host_playcorder:
             self.host_playcorder.record_note(self, pitch, volume, length if written_length is None else written_length,
@@ -1,12 +1,18 @@
 __author__ = 'mpevans'
 
 import math
+import bisect
+import numpy as np
 
 class Scale:
     def __init__(self, start_pitch, interval_series, repeat_interval):
         self.start_pitch = start_pitch
         self.interval_series = interval_series
         self.repeat_interval = repeat_interval
+        # lookup tables, which get rebuilt if the intervals are changed
+        self._tables_key = None
+        self._snapping_table = None
+        self._quantized_snapping_tables = {}
 
     def get_pitch_by_index(self, index):
         the_pitch = self.start_pitch
@@ -14,13 +20,89 @@ class Scale:
         note_of_scale = index % len(self.interval_series)
         return the_pitch + self.repeat_interval * octaves_up + self.interval_series[note_of_scale]
 
+    def get_pitches_by_index(self, indices):
+        # batch version of get_pitch_by_index for an array (or list) of integer indices
+        indices = np.asarray(indices, dtype=int)
+        octaves_up = np.floor_divide(indices, len(self.interval_series))
+        notes_of_scale = np.mod(indices, len(self.interval_series))
+        return self.start_pitch + self.repeat_interval * octaves_up + \
+            np.asarray(self.interval_series)[notes_of_scale]
+
     def round_pitch_to_scale(self, pitch):
         which_octave = math.floor((pitch - self.start_pitch) / self.repeat_interval)
         remainder = (pitch - self.start_pitch) % self.repeat_interval
-        dist = None
-        winning_interval = None
-        for interval in self.interval_series + [self.repeat_interval]:
-            if dist is None or abs(remainder - interval) < dist:
-                dist = abs(remainder - interval)
-                winning_interval = interval
-        return self.start_pitch + which_octave * self.repeat_interval + winning_interval
\ No newline at end of file
+        candidate_intervals, first_positions = self._get_snapping_table()
+        # the closest candidate is on one side or other of where the remainder would be inserted
+        right = bisect.bisect_left(candidate_intervals, remainder)
+        left = max(right - 1, 0)
+        right = min(right, len(candidate_intervals) - 1)
+        left_dist = abs(remainder - candidate_intervals[left])
+        right_dist = abs(remainder - candidate_intervals[right])
+        # on a tie, the interval that comes first in the interval series wins
+        if left_dist < right_dist or left_dist == right_dist and first_positions[left] < first_positions[right]:
+            winning_interval = candidate_intervals[left]
+        else:
+            winning_interval = candidate_intervals[right]
+        return self.start_pitch + which_octave * self.repeat_interval + winning_interval
+
+    def round_pitches_to_scale(self, pitches, quantization=None):
+        """
+        Batch version of round_pitch_to_scale.
+        :param pitches: an array (or list) of pitches
+        :param quantization: if given, the position of each pitch within the repeat interval is first rounded to a
+        multiple of this, and the snapped values are looked up in a table that is computed once per quantization.
+        Useful for microtonal scales, when pitches only need to be snapped to within (say) a cent anyway.
+        :return: a numpy array of the snapped pitches
+        """
+        pitches = np.asarray(pitches, dtype=float)
+        which_octave = np.floor((pitches - self.start_pitch) / self.repeat_interval)
+        remainders = np.mod(pitches - self.start_pitch, self.repeat_interval)
+        if quantization is None:
+            winning_intervals = self._snap_remainders(remainders)
+        else:
+            quantized_snapping_table = self._get_quantized_snapping_table(quantization)
+            grid_indices = np.floor(remainders / quantization + 0.5).astype(int)
+            winning_intervals = quantized_snapping_table[np.minimum(grid_indices, len(quantized_snapping_table) - 1)]
+        return self.start_pitch + which_octave * self.repeat_interval + winning_intervals
+
+    def _snap_remainders(self, remainders):
+        # for each remainder (position within the repeat interval), the closest candidate interval
+        candidate_intervals, first_positions = (np.array(x) for x in self._get_snapping_table())
+        right = np.searchsorted(candidate_intervals, remainders)
+        left = np.maximum(right - 1, 0)
+        right = np.minimum(right, len(candidate_intervals) - 1)
+        left_dist = np.abs(remainders - candidate_intervals[left])
+        right_dist = np.abs(remainders - candidate_intervals[right])
+        use_left = (left_dist < right_dist) | ((left_dist == right_dist) &
+                                               (first_positions[left] < first_positions[right]))
+        return np.where(use_left, candidate_intervals[left], candidate_intervals[right])
+
+    def _get_snapping_table(self):
+        # the candidate intervals (the interval series and the repeat interval on top) in sorted order, each along
+        # with the position at which it first shows up, since that's what settles ties
+        self._check_tables()
+        if self._snapping_table is None:
+            candidates = list(self.interval_series) + [self.repeat_interval]
+            first_positions = {}
+            for position, interval in enumerate(candidates):
+                first_positions.setdefault(interval, position)
+            candidate_intervals = sorted(first_positions)
+            self._snapping_table = (candidate_intervals, [first_positions[x] for x in candidate_intervals])
+        return self._snapping_table
+
+    def _get_quantized_snapping_table(self, quantization):
+        # the snapped interval for every multiple of the quantization from zero up to the repeat interval
+        self._check_tables()
+        if quantization not in self._quantized_snapping_tables:
+            grid_size = int(math.ceil(float(self.repeat_interval) / quantization)) + 1
+            self._quantized_snapping_tables[quantization] = \
+                self._snap_remainders(np.arange(grid_size) * float(quantization))
+        return self._quantized_snapping_tables[quantization]
+
+    def _check_tables(self):
+        # throw away the lookup tables if the intervals have been changed since they were made
+        tables_key = (tuple(self.interval_series), self.repeat_interval)
+        if tables_key != self._tables_key:
+            self._tables_key = tables_key
+            self._snapping_table = None
+            self._quantized_snapping_tables = {}
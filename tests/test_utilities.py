@@ -0,0 +1,52 @@
+__author__ = 'mpevans'
+
+import threading
+import unittest
+from marcpy.utilities import memoize, CyclicSequence
+
+
+class MemoizeTests(unittest.TestCase):
+
+    def test_bounded_cache_from_several_threads(self):
+        @memoize(max_size=4)
+        def square(x):
+            return x * x
+
+        errors = []
+
+        def hammer():
+            try:
+                for i in range(20000):
+                    assert square(i % 6) == (i % 6) ** 2
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=hammer) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(square.cache_info()["size"], 4)
+
+
+class CyclicSequenceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cs = CyclicSequence(range(7))
+
+    def test_non_negative_slices(self):
+        self.assertEqual(list(self.cs[5:9]), [5, 6, 0, 1])
+        self.assertEqual(list(self.cs[:3]), [0, 1, 2])
+
+    def test_negative_start(self):
+        self.assertEqual(list(self.cs[-2:3]), [5, 6, 0, 1, 2])
+        self.assertEqual(list(self.cs[-2:3]), list(self.cs.window(-2, 3)))
+
+    def test_negative_end(self):
+        self.assertEqual(list(self.cs[3:-2]), [3, 2, 1, 0, 6])
+        self.assertEqual(list(self.cs[-3:-1]), [4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,30 +3,108 @@ __author__ = 'mpevans'
 import os
 import sys
 import pickle
+import json
+import struct
 import inspect
 import math
 import numpy as np
 import bisect
 import copy
+import itertools
+import collections
+import functools
+import threading
 
 def enum(**named_values):
     return type('Enum', (), named_values)
 
 
-# decorator that saves function output
-def save_answers(func):
-    func.answers = {}
+class _NoLock:
+    # stands in for a real lock when a memoized function doesn't need to be thread-safe
+    def __enter__(self):
+        return self
 
-    def func_wrapper(*args):
-        t_args = tuple(args)
-        if t_args in func.answers:
-            return func.answers[t_args]
-        else:
-            ans = func(*args)
-            func.answers[t_args] = ans
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_memoized_functions = []
+
+
+def memoize(max_size=None, thread_safe=False):
+    """
+    Decorator factory for saving function output. Unlike save_answers, it can be bounded and reports how well it's doing.
+    :param max_size: the most answers to keep; once full, the least recently used answer is evicted. None means no limit.
+    :param thread_safe: if True, the answer dictionary is guarded by a lock so the function can be called from several
+    threads at once (the function itself may occasionally be called twice for the same arguments). A bounded cache
+    always uses a lock, since even a hit rearranges the dictionary.
+    The wrapped function gains cache_info(), which returns a dictionary of hits, misses, evictions, size and max_size,
+    and cache_clear(), which throws away all saved answers and resets the counts. Calls with unhashable arguments
+    (like numpy arrays) are simply passed through to the function.
+    """
+    def decorator(func):
+        answers = collections.OrderedDict()
+        counts = {"hits": 0, "misses": 0, "evictions": 0}
+        # (an unbounded cache only ever adds to the dictionary, which is safe enough without one)
+        lock = threading.RLock() if thread_safe or max_size is not None else _NoLock()
+
+        @functools.wraps(func)
+        def func_wrapper(*args, **kwargs):
+            key = args if len(kwargs) == 0 else (args, frozenset(kwargs.items()))
+            try:
+                with lock:
+                    if key in answers:
+                        counts["hits"] += 1
+                        if max_size is None:
+                            return answers[key]
+                        # move it to the end, so that the front of the dictionary is always the least recently used
+                        ans = answers.pop(key)
+                        answers[key] = ans
+                        return ans
+            except TypeError:
+                return func(*args, **kwargs)
+
+            ans = func(*args, **kwargs)
+            with lock:
+                counts["misses"] += 1
+                answers[key] = ans
+                while max_size is not None and len(answers) > max_size:
+                    answers.popitem(last=False)
+                    counts["evictions"] += 1
             return ans
 
-    return func_wrapper
+        def cache_info():
+            with lock:
+                return dict(counts, size=len(answers), max_size=max_size)
+
+        def cache_clear():
+            with lock:
+                answers.clear()
+                for which in counts:
+                    counts[which] = 0
+
+        func_wrapper.answers = answers
+        func_wrapper.cache_info = cache_info
+        func_wrapper.cache_clear = cache_clear
+        _memoized_functions.append(func_wrapper)
+        return func_wrapper
+
+    return decorator
+
+
+# decorator that saves function output (with no limit on how many answers are kept)
+def save_answers(func):
+    return memoize()(func)
+
+
+def get_memoization_stats():
+    # cache_info for every memoized function, keyed by module and function name
+    return {"{}.{}".format(f.__module__, f.__name__): f.cache_info() for f in _memoized_functions}
+
+
+def clear_memoized_answers():
+    for f in _memoized_functions:
+        f.cache_clear()
 
 
 # determines if application is a script file or frozen exe
@@ -53,6 +131,97 @@ def load_object(filename):
     return out
 
 
+# ------------------- Parameter array files -------------------
+# A binary format for parameter arrays (e.g. the curves edited in OneDParamEditor), which can be memory-mapped rather
+# than unpickled. The layout is: an 8-byte magic string, a 4-byte little-endian header length, a JSON header (with
+# the dtype, shape, data range and parameter name), padding up to a multiple of _param_array_alignment bytes, and
+# then the raw array data. Pickled (array_data, data_range, param_name) tuples are still read and written, so old
+# files keep working.
+
+param_array_file_extension = ".mparam"
+_param_array_magic = b"MPPARAM\x00"
+_param_array_format_version = 1
+_param_array_alignment = 64
+
+
+def save_param_array(array_data, data_range, param_name, filename):
+    array_data = np.ascontiguousarray(array_data)
+    header = json.dumps({"version": _param_array_format_version, "dtype": array_data.dtype.str,
+                         "shape": list(array_data.shape), "data_range": list(data_range), "param_name": param_name})
+    header_start = len(_param_array_magic) + 4
+    data_start = int(math.ceil(float(header_start + len(header)) / _param_array_alignment)) * _param_array_alignment
+    header += " " * (data_start - header_start - len(header))
+    # write to a temporary file and then move it into place; that way, anyone who has the old file memory-mapped
+    # (maybe even us, if we loaded from it) keeps seeing the old data rather than a half-written file
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as output:
+        output.write(_param_array_magic)
+        output.write(struct.pack("<I", len(header)))
+        output.write(header)
+        output.write(array_data.tostring())
+    if os.name == "nt" and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(temp_filename, filename)
+
+
+def is_param_array_file(filename):
+    with open(filename, "rb") as input_:
+        return input_.read(len(_param_array_magic)) == _param_array_magic
+
+
+def load_param_array(filename, mmap_mode="r"):
+    """
+    Loads a parameter array file saved with save_param_array.
+    :param filename: the file to load
+    :param mmap_mode: "r" for a read-only memory map, "c" for copy-on-write (changes stay in memory), "r+" to write
+    changes back to the file, or None to read the whole array into memory
+    :return: a tuple of (array_data, data_range, param_name)
+    """
+    with open(filename, "rb") as input_:
+        if input_.read(len(_param_array_magic)) != _param_array_magic:
+            raise ValueError("{} is not a parameter array file".format(filename))
+        header_length, = struct.unpack("<I", input_.read(4))
+        header = _json_strings_to_str(json.loads(input_.read(header_length).decode("utf-8")))
+        data_start = input_.tell()
+        if header["version"] > _param_array_format_version:
+            raise ValueError("{} was saved in a newer parameter array format".format(filename))
+        dtype = np.dtype(header["dtype"])
+        shape = tuple(header["shape"])
+        if mmap_mode is None:
+            array_data = np.fromfile(input_, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    if mmap_mode is not None:
+        # np.memmap can't map an empty array, but then there's nothing to be lazy about
+        array_data = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=data_start, shape=shape) \
+            if np.prod(shape) > 0 else np.empty(shape, dtype=dtype)
+    return array_data, tuple(header["data_range"]), header["param_name"]
+
+
+def _json_strings_to_str(value):
+    # json hands back unicode strings, but the param name (and anything else in the header) went in as a str
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_json_strings_to_str(x) for x in value]
+    if isinstance(value, dict):
+        return {_json_strings_to_str(k): _json_strings_to_str(v) for k, v in value.items()}
+    return value
+
+
+def save_param_file(array_data, data_range, param_name, filename):
+    # saves in the binary format if the file has the binary extension or is already a binary file; otherwise pickles
+    if filename.endswith(param_array_file_extension) or os.path.exists(filename) and is_param_array_file(filename):
+        save_param_array(array_data, data_range, param_name, filename)
+    else:
+        save_object((array_data, data_range, param_name), filename)
+
+
+def load_param_file(filename, mmap_mode="r"):
+    # loads either kind of parameter file, returning a tuple of (array_data, data_range, param_name)
+    if is_param_array_file(filename):
+        return load_param_array(filename, mmap_mode=mmap_mode)
+    return load_object(filename)
+
+
 pc_number_to_name = {
     0: "C",
     1: "C#/Db",
@@ -87,6 +256,22 @@ def get_pitch_description(pitch, accidental_type="standard"):
     return pc_name + str(octave)
 
 
+def get_pitch_descriptions(pitches, accidental_type="standard"):
+    """
+    Batch version of get_pitch_description.
+    :param pitches: an array (or list) of midi pitches
+    :param accidental_type: as in get_pitch_description
+    :return: a numpy array of strings, the same shape as pitches
+    """
+    pitches = np.asarray(pitches, dtype=float)
+    # the description only depends on the rounded pitch, and there are only ever a handful of those, so we
+    # describe each distinct one once and then spread the descriptions back out
+    rounded_pitches = np.copysign(np.floor(np.abs(pitches) + 0.5), pitches)
+    distinct_pitches, which_pitch = np.unique(rounded_pitches, return_inverse=True)
+    descriptions = np.array([get_pitch_description(p, accidental_type) for p in distinct_pitches.tolist()])
+    return descriptions[which_pitch].reshape(pitches.shape)
+
+
 def get_pitch_class_description(pitch_class, accidental_type="standard"):
     pc_name = pc_number_to_name[pitch_class]
     if "/" in pc_name and accidental_type != "both":
@@ -103,6 +288,7 @@ def get_pitch_class_description(pitch_class, accidental_type="standard"):
     return pc_name
 
 
+@memoize(max_size=1000)
 def get_interval_cycle_length(cycle_size):
     x = cycle_size
     length = 1
@@ -112,6 +298,7 @@ def get_interval_cycle_length(cycle_size):
     return length
 
 
+@memoize(max_size=100000)
 def get_interval_cycle_distance(pc1, pc2, cycle_size):
     cycle_length = get_interval_cycle_length(cycle_size)
     distance = 0
@@ -146,23 +333,38 @@ def round_x_to_pow_of_y(x, y):
     return y ** (int(round(a)) if isinstance(y, int) else round(a))
 
 
+# the following conversions all accept either a single number or an array (or list) of them. Single numbers take
+# the plain math path, since numpy has a lot of overhead for one value; arrays are converted in one go.
+
 def midi_to_freq(midi_val):
+    if hasattr(midi_val, "__len__"):
+        return 440.0 * np.power(2.0, (np.asarray(midi_val, dtype=float) - 69.0)/12)
     return 440.0 * 2**((midi_val - 69.0)/12)
 
 
 def freq_to_midi(frequency):
+    if hasattr(frequency, "__len__"):
+        return np.log2(np.asarray(frequency, dtype=float)/440.0) * 12 + 69.0
     return math.log(frequency/440.0, 2.0) * 12 + 69.0
 
 
 def cents_to_ratio(cents):
+    if hasattr(cents, "__len__"):
+        return np.power(2.0, np.asarray(cents, dtype=float)/1200.0)
     return 2**(cents/1200.0)
 
 
 def ratio_to_cents(ratio):
+    if hasattr(ratio, "__len__"):
+        return np.log(np.asarray(ratio, dtype=float))/math.log(2) * 1200.0
     return math.log(ratio)/math.log(2) * 1200.0
 
 
 def round_to_multiple(x, factor):
+    if hasattr(x, "__len__") or hasattr(factor, "__len__"):
+        quotient = np.asarray(x, dtype=float) / factor
+        # np.round rounds halves to even, whereas round rounds them away from zero; we want the latter
+        return np.copysign(np.floor(np.abs(quotient) + 0.5), quotient) * factor
     return round(x/factor)*factor
 
 
@@ -211,17 +413,49 @@ def get_rejection_of_a_onto_b(a, b):
 # --------------------- list stuff ---------------------------
 
 
+def iter_flattened(l, indivisible_type=None):
+    """
+    Lazily flattens arbitrarily nested lists (or anything else with a length), depth first. Works iteratively, using
+    a stack of iterators, so deep or long nestings cost no more than the number of elements.
+    :param l: the (possibly nested) list
+    :param indivisible_type: a type (or tuple of types) that we don't want to divide, even though it has a length.
+    Strings are never divided.
+    """
+    stack = [iter(l)]
+    while len(stack) > 0:
+        for item in stack[-1]:
+            if hasattr(item, "__len__") and not isinstance(item, basestring) \
+                    and (indivisible_type is None or not isinstance(item, indivisible_type)):
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop()
+
+
 def make_flat_list(l, indivisible_type=None):
     # indivisible_type is a type that we don't want to divide,
-    new_list = list(l)
-    i = 0
-    while i < len(new_list):
-        if hasattr(new_list[i], "__len__"):
-            if indivisible_type is None or not isinstance(new_list[i], indivisible_type):
-                new_list = new_list[:i] + new_list[i] + new_list[i+1:]
+    return list(iter_flattened(l, indivisible_type))
+
+
+def splice_in_place(l, replacements):
+    """
+    Replaces elements of a list with runs of new elements, all in one linear pass, modifying the list in place.
+    (Much quicker than replacing elements with sub-lists and flattening afterwards, or splicing one at a time.)
+    :param l: the list to modify
+    :param replacements: a dictionary mapping indices (in the original list) to lists of elements that replace them
+    :return: the same list, for convenience
+    """
+    if len(replacements) == 0:
+        return l
+    spliced = []
+    for i, item in enumerate(l):
+        if i in replacements:
+            spliced.extend(replacements[i])
         else:
-            i += 1
-    return new_list
+            spliced.append(item)
+    l[:] = spliced
+    return l
 
 
 def get_interpolated_array_value(array, index, power=1, cyclic=False, normalized=False):
@@ -248,6 +482,52 @@ def get_interpolated_array_value(array, index, power=1, cyclic=False, normalized
     return lower_index_value * (1 - progress_to_next) + upper_index_value * progress_to_next
 
 
+def get_interpolated_array_values(array, indices, power=1, cyclic=False, normalized=False):
+    """
+    Array version of get_interpolated_array_value: looks up a whole array (or list) of indices at once.
+    :param array: the array of values to interpolate between
+    :param indices: the (fractional) indices to look up
+    :param power: as in get_interpolated_array_value
+    :param cyclic: as in get_interpolated_array_value
+    :param normalized: as in get_interpolated_array_value
+    :return: a numpy array of interpolated values, the same shape as indices
+    """
+    values = np.asarray(array, dtype=float)
+    length = len(values)
+    indices = np.asarray(indices, dtype=float)
+    if normalized:
+        indices = np.round(indices * length, 10)
+    if cyclic:
+        out_of_range = (indices < 0) | (indices >= length - 1)
+        indices = np.where(out_of_range, np.mod(indices, length), indices)
+    else:
+        # off either end we just take the end value, which is what we get by clipping
+        indices = np.clip(indices, 0, length - 1)
+
+    lower_indices = np.floor(indices)
+    progress_to_next = (indices - lower_indices) ** power
+    # (the modulus guards against np.mod rounding a tiny negative index up to exactly length)
+    lower_indices = lower_indices.astype(int) % length
+    lower_index_values = values[lower_indices]
+    upper_index_values = values[(lower_indices + 1) % length]
+    return np.where(progress_to_next == 0, lower_index_values,
+                    lower_index_values * (1 - progress_to_next) + upper_index_values * progress_to_next)
+
+
+def get_resampled_array(array, num_samples, power=1, cyclic=False):
+    """
+    Resamples an array so that it stretches across num_samples evenly spaced points, e.g. to turn a parameter
+    curve into one value per control tick. Sample k is the value at percent k / num_samples of the way through.
+    :param array: the array of values to resample
+    :param num_samples: how many samples we want
+    :param power: as in get_interpolated_array_value
+    :param cyclic: as in get_interpolated_array_value
+    :return: a numpy array of length num_samples
+    """
+    indices = np.arange(num_samples) * (float(len(array)) / num_samples)
+    return get_interpolated_array_values(array, indices, power=power, cyclic=cyclic)
+
+
 def get_closest_index(myList, value):
     """
     Assumes myList is sorted. Returns closest value to myNumber.
@@ -306,6 +586,111 @@ def cyclic_slice(l, start, end):
         return cyclic_slice(new_list, new_start, new_end)
 
 
+class CyclicWindow:
+    """
+    A read-only, wrap-around window onto a sequence that doesn't copy it. Contains sequence[k % len(sequence)] for k
+    going from start up to (but not including) end, or, if end is before start, from start down to (but not
+    including) end. In other words, the same elements cyclic_slice would give, in the same order.
+    """
+
+    def __init__(self, sequence, start, end):
+        self.sequence = sequence
+        self.start = start
+        self.end = end
+        self.step = 1 if end >= start else -1
+
+    def __len__(self):
+        return abs(self.end - self.start)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("CyclicWindow index out of range")
+        return self.sequence[(self.start + self.step * item) % len(self.sequence)]
+
+    def __iter__(self):
+        if self.step < 0:
+            sequence_length = len(self.sequence)
+            return itertools.imap(self.sequence.__getitem__,
+                                  (k % sequence_length for k in xrange(self.start, self.end, -1)))
+        # going forwards, we can chain together direct lookups into the underlying sequence, one run per lap around
+        # it (islice would be no good here, since it has to step through everything before the start index)
+        sequence_length = len(self.sequence)
+        position = self.start % sequence_length
+        remaining = len(self)
+        pieces = []
+        while remaining > 0:
+            piece_length = min(remaining, sequence_length - position)
+            pieces.append(itertools.imap(self.sequence.__getitem__, xrange(position, position + piece_length)))
+            remaining -= piece_length
+            position = 0
+        return itertools.chain(*pieces)
+
+    def __repr__(self):
+        return "CyclicWindow({}, {}, {})".format(self.sequence, self.start, self.end)
+
+
+class CyclicSequence(object):
+    """
+    Wraps a sequence so that any integer index is valid (wrapping around), and slices come back as CyclicWindows
+    rather than copies.
+    """
+    # (this has to be a new-style class: python 2 hands simple slices of old-style instances to __getslice__ with the
+    # length already added to any negative bounds, and the whole point here is that negative bounds wrap around)
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            assert item.step is None, "CyclicSequence slices can't have a step"
+            start = 0 if item.start is None else item.start
+            end = len(self.sequence) if item.stop is None else item.stop
+            return self.window(start, end)
+        return self.sequence[item % len(self.sequence)]
+
+    def __iter__(self):
+        return iter(self.sequence)
+
+    def window(self, start, end):
+        return CyclicWindow(self.sequence, start, end)
+
+    def iter_windows(self, max_size, min_size=1, cyclic=True):
+        # see iter_sliding_windows
+        return iter_sliding_windows(self.sequence, max_size, min_size, cyclic)
+
+
+def iter_sliding_windows(sequence, max_size, min_size=1, cyclic=True):
+    """
+    Iterates through every window of every size from min_size to max_size, smallest size first and then in order of
+    start index. Windows come out as tuples, since that's usually what's wanted (e.g. for dictionary keys), and
+    they are built by zipping together staggered iterators, so there's no per-window slicing or concatenation.
+    :param sequence: the sequence to take windows of
+    :param max_size: the largest window size
+    :param min_size: the smallest window size
+    :param cyclic: if True, windows start at every index and wrap around the end of the sequence; otherwise only
+    windows that fit inside the sequence are included
+    """
+    sequence_length = len(sequence)
+    if sequence_length == 0:
+        return
+    for size in range(min_size, max_size + 1):
+        if cyclic:
+            # one pass through the sequence, plus enough wrapped-around elements for the last window
+            extended = [sequence[k % sequence_length] for k in xrange(sequence_length + size - 1)]
+        else:
+            extended = sequence
+        staggered = [itertools.islice(extended, k, None) for k in range(size)]
+        for window in itertools.izip(*staggered):
+            yield window
+
+
 class CyclingTuple:
     def __init__(self, *tuples_that_cycle):
         self.tuples = tuples_that_cycle